@@ -0,0 +1,294 @@
+# broadcast.py
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from dotenv import load_dotenv
+
+from db import create_broadcast_job, finish_broadcast_job, get_pending_broadcast_jobs, update_broadcast_job
+
+# --- ЗАГРУЗКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ---
+load_dotenv()
+
+# --- НАСТРОЙКИ РАССЫЛКИ ---
+# Сообщений в секунду: Telegram разрешает боту около 30 в секунду в разные чаты
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+# Сколько сообщений отправляется одновременно
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 5))
+# Как часто (в секундах) обновлять сообщение с ходом рассылки и сохранять его в хранилище.
+# Каждое сохранение в JSONBin без шардов перезаписывает весь документ, поэтому ход сохраняется
+# не после каждого сообщения: после аварийной остановки получатели, обработанные после
+# последнего сохранения (до BROADCAST_RATE * BROADCAST_PROGRESS_INTERVAL человек), получат его еще раз
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 3))
+# Сколько раз повторять отправку одному получателю после RetryAfter
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, запас не больше capacity.
+
+    Каждая отправка забирает один токен. После RetryAfter ведро закрывается
+    целиком, потому что лимит Telegram общий для всех чатов бота.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """Ждет свободный токен и забирает его"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает выдачу токенов на seconds секунд"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated = max(self._updated, self._paused_until)
+
+
+STATUS_ICONS = {"queued": "🕓", "running": "📤", "finished": "✅"}
+
+
+def _total(job: Dict[str, Any]) -> int:
+    # Задания, созданные до поля total, хранят только список получателей
+    return job.get("total", len(job.get("recipients", [])))
+
+
+def describe_broadcast(job: Dict[str, Any]) -> str:
+    """Текст с ходом или итогами рассылки"""
+    total = _total(job)
+    processed = job["sent"] + job["blocked"] + job["failed"]
+    percent = processed * 100 // total if total else 100
+    headers = {
+        "queued": f"🕓 Рассылка #{job['id']} в очереди.",
+        "running": f"📤 Идет рассылка #{job['id']}...",
+        "finished": f"✅ Рассылка #{job['id']} завершена.",
+    }
+    lines = [
+        headers.get(job["status"], f"Рассылка #{job['id']}"),
+        f"Обработано: {processed} из {total} ({percent}%)",
+        f"Успешно отправлено: {job['sent']}",
+        f"Заблокировали бота: {job['blocked']}",
+        f"Не удалось отправить: {job['failed']}",
+    ]
+    if job.get("started_at"):
+        finished_at = datetime.fromisoformat(job["finished_at"]) if job.get("finished_at") else datetime.now()
+        elapsed = finished_at - datetime.fromisoformat(job["started_at"])
+        lines.append(f"Время: {int(elapsed.total_seconds())} с")
+    return "\n".join(lines)
+
+
+def short_broadcast_label(job: Dict[str, Any]) -> str:
+    """Короткая подпись задания для кнопки админ-панели"""
+    processed = job["sent"] + job["blocked"] + job["failed"]
+    return f"{STATUS_ICONS.get(job['status'], '')} Рассылка #{job['id']}: {processed}/{_total(job)}"
+
+
+class BroadcastJob:
+    """Выполнение одного сохраненного задания рассылки.
+
+    Ход рассылки (cursor, done и счетчики) сохраняется в хранилище раз
+    в BROADCAST_PROGRESS_INTERVAL и при остановке бота, поэтому после перезапуска
+    задание продолжается с последнего сохраненного места. Получатели, обработанные
+    после него перед аварийной остановкой, получат сообщение повторно.
+    """
+
+    def __init__(self, bot: Bot, bucket: TokenBucket, job: Dict[str, Any]):
+        self.bot = bot
+        self.bucket = bucket
+        self.job = job
+        job.setdefault("total", len(job["recipients"]))
+        # Номера получателей после cursor, которые уже обработаны параллельными обработчиками
+        self._done = set(job.get("done", []))
+        self._last_render = ""
+
+    def _mark_done(self, position: int) -> None:
+        self._done.add(position)
+        while self.job["cursor"] in self._done:
+            self._done.discard(self.job["cursor"])
+            self.job["cursor"] += 1
+
+    def _progress(self) -> Dict[str, Any]:
+        return {
+            "cursor": self.job["cursor"],
+            "done": sorted(self._done),
+            "total": self.job["total"],
+            "sent": self.job["sent"],
+            "blocked": self.job["blocked"],
+            "failed": self.job["failed"],
+        }
+
+    async def run(self) -> None:
+        """Отправляет сообщения оставшимся получателям пулом из BROADCAST_CONCURRENCY обработчиков"""
+        if self.job["status"] != "running":
+            self.job.update(status="running", started_at=datetime.now().isoformat())
+            await update_broadcast_job(self.job["id"], {"status": "running", "started_at": self.job["started_at"]})
+
+        # Общий итератор: каждый обработчик берет следующего получателя, пока они не кончатся
+        queue = (position for position in range(self.job["cursor"], len(self.job["recipients"]))
+                 if position not in self._done)
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            await asyncio.gather(*(self._worker(queue) for _ in range(max(1, BROADCAST_CONCURRENCY))))
+        finally:
+            reporter.cancel()
+            # При остановке бота задание остается в статусе running и продолжится после запуска
+            await update_broadcast_job(self.job["id"], self._progress())
+
+        self.job.update(status="finished", finished_at=datetime.now().isoformat())
+        await finish_broadcast_job(self.job["id"], self.job["finished_at"])
+
+        await self._edit_progress(describe_broadcast(self.job))
+        try:
+            await self.bot.send_message(self.job["admin_id"], describe_broadcast(self.job))
+        except Exception as e:
+            logger.error(f"Не удалось отправить итоги рассылки: {e}")
+
+    async def _worker(self, queue) -> None:
+        for position in queue:
+            await self._send(self.job["recipients"][position])
+            self._mark_done(position)
+
+    async def _send(self, user_id: int) -> None:
+        """Отправляет сообщение одному получателю и учитывает результат"""
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=user_id, text=self.job["text"])
+                self.job["sent"] += 1
+                return
+            except TelegramRetryAfter as e:
+                logger.warning(f"Рассылка: превышен лимит Telegram, пауза {e.retry_after} с")
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                # Пользователь заблокировал бота или удалил аккаунт — повторять бесполезно
+                self.job["blocked"] += 1
+                return
+            except Exception as e:
+                logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+                self.job["failed"] += 1
+                return
+
+        logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: лимит повторов исчерпан")
+        self.job["failed"] += 1
+
+    async def _report_progress(self) -> None:
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await update_broadcast_job(self.job["id"], self._progress())
+            await self._edit_progress(describe_broadcast(self.job))
+
+    async def _edit_progress(self, text: str) -> None:
+        if text == self._last_render or not self.job.get("progress_message_id"):
+            return
+        try:
+            await self.bot.edit_message_text(chat_id=self.job["admin_id"],
+                                             message_id=self.job["progress_message_id"], text=text)
+            self._last_render = text
+        except TelegramRetryAfter as e:
+            # Прогресс не важнее самой рассылки: пропускаем обновление
+            self.bucket.pause(e.retry_after)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logger.error(f"Ошибка обновления хода рассылки: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка обновления хода рассылки: {e}")
+
+
+class BroadcastQueue:
+    """Очередь рассылок: задания из хранилища выполняются по одному в порядке постановки.
+
+    Лимит Telegram общий на бота, поэтому параллельные рассылки не ускоряют отправку,
+    а ведро токенов у очереди одно на все задания.
+    """
+
+    def __init__(self):
+        self.bot: Optional[Bot] = None
+        self.bucket = TokenBucket(BROADCAST_RATE)
+        self.current: Optional[BroadcastJob] = None
+        self._task: Optional[asyncio.Task] = None
+        # Появились новые задания, пока очередь проверяла хранилище
+        self._wakeup = False
+
+    def start(self, bot: Bot) -> None:
+        """Запускает обработку очереди, если она еще не идет"""
+        self.bot = bot
+        self._wakeup = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup = False
+            jobs = await get_pending_broadcast_jobs()
+            if not jobs:
+                if self._wakeup:
+                    continue
+                break
+
+            self.current = BroadcastJob(self.bot, self.bucket, jobs[0])
+            try:
+                await self.current.run()
+            except Exception as e:
+                logger.error(f"Ошибка рассылки #{jobs[0]['id']}: {e}")
+                # Не даем сломанному заданию заблокировать очередь
+                if not await finish_broadcast_job(jobs[0]["id"], datetime.now().isoformat()):
+                    break
+            finally:
+                self.current = None
+
+    async def stop(self) -> None:
+        """Останавливает рассылку, сохраняя ее ход для продолжения после запуска"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+
+# --- ФОНОВЫЕ РАССЫЛКИ ---
+broadcast_queue = BroadcastQueue()
+
+
+async def enqueue_broadcast(bot: Bot, admin_id: int, progress_message_id: int, text: str,
+                            recipients: List[int]) -> int:
+    """Сохраняет рассылку в очередь, запускает ее обработку в фоне и сразу возвращает ID задания"""
+    job_id = await create_broadcast_job(admin_id, progress_message_id, text, recipients)
+    broadcast_queue.start(bot)
+    return job_id
+
+
+def resume_broadcasts(bot: Bot) -> None:
+    """Продолжает незавершенные рассылки после запуска бота"""
+    broadcast_queue.start(bot)
+
+
+async def stop_broadcasts() -> None:
+    """Останавливает рассылку при выключении бота"""
+    await broadcast_queue.stop()
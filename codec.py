@@ -0,0 +1,222 @@
+# codec.py
+import base64
+import json
+import sys
+import zlib
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional, Union
+
+from storage import COLLECTIONS
+
+# Номер компактного формата. Документы без поля "format" лежат в исходном виде:
+# коллекции — словари записей {ID: {поле: значение}}
+COMPACT_FORMAT = 2
+
+# Поля, которые остаются в корне документа как есть: версию JSONBin отдает по X-JSON-Path
+PLAIN_KEYS = ("version",)
+
+# Коллекции, записи которых хранятся колонками отдельно для каждой сессии
+SESSION_COLLECTIONS = ("transactions", "debts")
+
+# Поля с датами ISO, которые хранятся секундами от эпохи
+TIME_FIELDS = ("created_at", "updated_at", "closed_at", "last_updated", "last_active", "access_expiry",
+               "started_at", "finished_at")
+
+# Поля с повторяющимися строками, которые хранятся номерами в общей таблице строк
+CODE_FIELDS = ("type", "currency", "role", "status")
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def compact_dumps(value: Any) -> str:
+    """JSON без пробелов и с кириллицей как есть, а не \\uXXXX"""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+# --- ДАТЫ ---
+
+def _encode_time(value: Any) -> Optional[Union[int, float]]:
+    """Секунды от эпохи для даты ISO или None, если из них не восстановить ту же строку"""
+    if not isinstance(value, str):
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if moment.tzinfo is not None or moment.isoformat() != value:
+        return None
+    seconds = (moment - EPOCH) / timedelta(seconds=1)
+    return int(seconds) if seconds.is_integer() else seconds
+
+
+def _decode_time(seconds: Union[int, float]) -> str:
+    return (EPOCH + timedelta(seconds=seconds)).isoformat()
+
+
+# --- КОЛЛЕКЦИИ ---
+
+def _encode_id(key: str) -> Union[int, str]:
+    return int(key) if key.isdigit() and str(int(key)) == key else key
+
+
+def _encode_table(table: Dict[str, Dict[str, Any]], by_session: bool,
+                  strings: Dict[str, int]) -> Dict[str, Any]:
+    """Раскладывает коллекцию на группы записей с одинаковым набором полей (и сессией).
+    В группе значения каждого поля лежат одним массивом"""
+    groups: Dict[Any, Dict[str, Any]] = {}
+    for key, record in table.items():
+        const = {"session_id": record["session_id"]} if by_session and "session_id" in record else {}
+        fields = [field for field in record if field not in const]
+        group_key = (tuple(fields), compact_dumps(const))
+        group = groups.get(group_key)
+        if group is None:
+            group = groups[group_key] = {"ids": [], "fields": fields, "columns": [[] for _ in fields], "const": const}
+        group["ids"].append(_encode_id(key))
+        for column, field in zip(group["columns"], fields):
+            column.append(record[field])
+
+    encoded = []
+    for group in groups.values():
+        times, codes = [], []
+        for index, field in enumerate(group["fields"]):
+            column = group["columns"][index]
+            if field in TIME_FIELDS:
+                seconds = [_encode_time(value) for value in column]
+                # Колонка переводится, только если без потерь переводится каждое значение
+                if all(value is None or second is not None for value, second in zip(column, seconds)):
+                    group["columns"][index] = seconds
+                    times.append(field)
+            elif field in CODE_FIELDS and all(value is None or isinstance(value, str) for value in column):
+                group["columns"][index] = [None if value is None else strings.setdefault(value, len(strings))
+                                           for value in column]
+                codes.append(field)
+        if times:
+            group["times"] = times
+        if codes:
+            group["codes"] = codes
+        if not group["const"]:
+            del group["const"]
+        encoded.append(group)
+
+    # Порядок записей сохраняется: чаще всего он совпадает с порядком ID
+    keys = list(table)
+    if keys == [str(record_id) for group in encoded for record_id in group["ids"]]:
+        return {"groups": encoded}
+    if all(key.isdigit() for key in keys) and keys == sorted(keys, key=int):
+        return {"groups": encoded, "order": "id"}
+    return {"groups": encoded, "order": [_encode_id(key) for key in keys]}
+
+
+def _decode_table(encoded: Dict[str, Any], strings: List[str]) -> Dict[str, Dict[str, Any]]:
+    table = {}
+    for group in encoded["groups"]:
+        times = set(group.get("times", ()))
+        codes = set(group.get("codes", ()))
+        columns = []
+        for field, column in zip(group["fields"], group["columns"]):
+            if field in times:
+                column = [None if value is None else _decode_time(value) for value in column]
+            elif field in codes:
+                column = [None if value is None else strings[value] for value in column]
+            columns.append(column)
+
+        const = group.get("const", {})
+        for row, record_id in enumerate(group["ids"]):
+            record = dict(const)
+            for field, column in zip(group["fields"], columns):
+                record[field] = column[row]
+            table[str(record_id)] = record
+
+    order = encoded.get("order")
+    if order == "id":
+        return dict(sorted(table.items(), key=lambda item: int(item[0])))
+    if order is not None:
+        return {str(record_id): table[str(record_id)] for record_id in order}
+    return table
+
+
+# --- ДОКУМЕНТ ---
+
+def encode_document(data: Dict[str, Any], compress: bool = False) -> Dict[str, Any]:
+    """Переводит документ в компактный формат; с compress тело сжимается zlib"""
+    strings: Dict[str, int] = {}
+    tables, extra = {}, {}
+    for key, value in data.items():
+        if key in PLAIN_KEYS:
+            continue
+        if key in COLLECTIONS and isinstance(value, dict):
+            tables[key] = _encode_table(value, key in SESSION_COLLECTIONS, strings)
+        else:
+            extra[key] = value
+    body = {"strings": list(strings), "tables": tables, "extra": extra}
+
+    encoded = {"format": COMPACT_FORMAT, **{key: data[key] for key in PLAIN_KEYS if key in data}}
+    if compress:
+        packed = zlib.compress(compact_dumps(body).encode("utf-8"), 9)
+        encoded["zlib"] = base64.b64encode(packed).decode("ascii")
+    else:
+        encoded["body"] = body
+    return encoded
+
+
+def decode_document(stored: Dict[str, Any]) -> Dict[str, Any]:
+    """Восстанавливает документ из компактного формата; документ в исходном виде возвращается как есть"""
+    stored_format = stored.get("format")
+    if stored_format is None:
+        return stored
+    if stored_format != COMPACT_FORMAT:
+        raise ValueError(f"Неизвестный формат документа: {stored_format}")
+
+    if "zlib" in stored:
+        body = json.loads(zlib.decompress(base64.b64decode(stored["zlib"])).decode("utf-8"))
+    else:
+        body = stored["body"]
+    data = dict(body["extra"])
+    for collection, table in body["tables"].items():
+        data[collection] = _decode_table(table, body["strings"])
+    for key in PLAIN_KEYS:
+        if key in stored:
+            data[key] = stored[key]
+    return data
+
+
+def is_compact(stored: Dict[str, Any]) -> bool:
+    return stored.get("format") == COMPACT_FORMAT
+
+
+# --- СРАВНЕНИЕ РАЗМЕРОВ ---
+
+def size_report(data: Dict[str, Any]) -> Dict[str, int]:
+    """Размер документа в байтах в каждом из форматов"""
+    return {
+        # Так документ отправлялся до компактного формата: json.dumps по умолчанию
+        "json": len(json.dumps(data).encode("utf-8")),
+        "json_utf8": len(compact_dumps(data).encode("utf-8")),
+        "compact": len(compact_dumps(encode_document(data)).encode("utf-8")),
+        "compact_zlib": len(compact_dumps(encode_document(data, compress=True)).encode("utf-8")),
+    }
+
+
+def format_size_report(report: Dict[str, int]) -> str:
+    """Таблица размеров для вывода в консоль"""
+    labels = {
+        "json": "JSON (исходный)",
+        "json_utf8": "JSON без пробелов, UTF-8",
+        "compact": "Компактный",
+        "compact_zlib": "Компактный + zlib",
+    }
+    base = report["json"] or 1
+    return "\n".join(f"{labels[name]:<26}{size:>12} байт  {size * 100 / base:6.1f}%"
+                     for name, size in report.items())
+
+
+if __name__ == "__main__":
+    # Отчет по выгрузке бина или локальной копии: python codec.py master.json
+    if len(sys.argv) != 2:
+        print("Использование: python codec.py <файл документа>")
+        sys.exit(1)
+    with open(sys.argv[1], encoding="utf-8") as file:
+        document = json.load(file)
+    # Локальная копия документа хранит его под ключом "data", выгрузка JSONBin — под "record"
+    document = document.get("data", document.get("record", document))
+    print(format_size_report(size_report(decode_document(document))))
@@ -1,233 +1,626 @@
 # db.py
+import asyncio
+import copy
 import json
 import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional, Tuple
-import requests
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
 from dotenv import load_dotenv
 import numpy as np
 
+import storage
+from storage import StorageBackend, UnitOfWork
+
 # --- ЗАГРУЗКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ---
 load_dotenv()
 
+# --- НАСТРОЙКИ ХРАНИЛИЩА ---
+# jsonbin — документ на JSONBin, sqlite — локальный файл SQLite
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "jsonbin").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.db")
+
 # --- НАСТРОЙКИ JSONBIN ---
 JSONBIN_API_KEY = os.getenv("JSONBIN_API_KEY")
 MASTER_BIN_ID = os.getenv("MASTER_BIN_ID")
+# Максимум одновременных соединений с JSONBin в общей HTTP-сессии
+JSONBIN_POOL_SIZE = int(os.getenv("JSONBIN_POOL_SIZE", 10))
+# Таймаут одного запроса к JSONBin в секундах и число повторов после сетевой ошибки, 429 или 5xx
+JSONBIN_TIMEOUT = float(os.getenv("JSONBIN_TIMEOUT", 10))
+JSONBIN_RETRIES = int(os.getenv("JSONBIN_RETRIES", 3))
+# Число бинов-корзин для сессий, транзакций и долгов; 0 — всё в мастер-бине
+JSONBIN_SHARD_COUNT = int(os.getenv("JSONBIN_SHARD_COUNT", 0))
+# Интервал отложенной записи в секундах; 0 — каждое изменение сохраняется сразу
+JSONBIN_FLUSH_INTERVAL = float(os.getenv("JSONBIN_FLUSH_INTERVAL", 0))
+# Как часто (в секундах) сверять версии документов с JSONBin при нескольких экземплярах; 0 — не сверять
+JSONBIN_SYNC_INTERVAL = float(os.getenv("JSONBIN_SYNC_INTERVAL", 0))
+# Сверять версию документа перед каждым сохранением и повторять свои изменения поверх более новой.
+# Нужно, когда в JSONBin пишут несколько экземпляров бота; стоит лишнего запроса на сохранение
+JSONBIN_OPTIMISTIC_LOCKING = os.getenv("JSONBIN_OPTIMISTIC_LOCKING", "0").lower() in ("1", "true", "yes")
+# Журнал изменений в JSONBin: сохранение дописывает изменения в бин журнала, а документ
+# перезаписывается целиком, когда журнал вырос больше этой доли от документа (например, 0.25);
+# 0 — журнал не ведется, документ всегда сохраняется целиком
+JSONBIN_LOG_RATIO = float(os.getenv("JSONBIN_LOG_RATIO", 0))
+# Папка для локальных копий документов JSONBin: запуск читает их с диска, а версия в JSONBin
+# сверяется в фоне. Пусто — копии не ведутся. На Railway папка должна лежать на volume
+JSONBIN_SNAPSHOT_DIR = os.getenv("JSONBIN_SNAPSHOT_DIR", "")
+# Формат документов в JSONBin: json — как раньше, compact — колонками по сессиям с датами
+# в секундах и номерами типов, zlib — compact со сжатием. Документ в другом формате читается
+# и при следующем сохранении переводится. compact и zlib включайте, только когда все запущенные
+# версии бота их читают: старая версия не прочитает такой бин
+JSONBIN_FORMAT = os.getenv("JSONBIN_FORMAT", "json").lower()
+
+# Файл локального журнала записи: изменения подтверждаются после записи на диск,
+# а в JSONBin уходят в фоне. Пусто — журнал выключен. На Railway файл должен лежать на volume
+WRITE_JOURNAL_PATH = os.getenv("WRITE_JOURNAL_PATH", "")
+
+# --- НАСТРОЙКИ НЕСКОЛЬКИХ ЭКЗЕМПЛЯРОВ ---
+# Канал уведомлений о сохраненных версиях: local — внутри процесса, none — без уведомлений
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", "local").lower()
+
+# --- НАСТРОЙКИ КЭША ---
+# Сколько сессий с посчитанной аналитикой держать в памяти
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", 128))
+# Как часто (в секундах) сохранять накопленное время активности пользователей
+ACTIVITY_FLUSH_INTERVAL = int(os.getenv("ACTIVITY_FLUSH_INTERVAL", 60))
+
+
+def create_storage() -> StorageBackend:
+    """Создает хранилище, выбранное в STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "sqlite":
+        from sqlite_storage import SQLiteManager
+        return SQLiteManager(SQLITE_PATH)
+
+    if STORAGE_BACKEND == "jsonbin":
+        if not JSONBIN_API_KEY:
+            raise ValueError("JSONBIN_API_KEY не найден в переменных окружения")
+        if not MASTER_BIN_ID:
+            raise ValueError("MASTER_BIN_ID не найден в переменных окружения")
+
+        if JSONBIN_FORMAT not in ("json", "compact", "zlib"):
+            raise ValueError(f"Неизвестный формат JSONBIN_FORMAT={JSONBIN_FORMAT}")
+
+        from jsonbin_storage import JSONBinManager
+        from invalidation import create_invalidation_channel
+        channel = create_invalidation_channel(INVALIDATION_CHANNEL) if INVALIDATION_CHANNEL != "none" else None
+        # Журнал подтверждает записи только после flush(), поэтому требует отложенной записи
+        flush_interval = JSONBIN_FLUSH_INTERVAL or (1 if WRITE_JOURNAL_PATH else 0)
+        backend = JSONBinManager(JSONBIN_API_KEY, MASTER_BIN_ID, JSONBIN_POOL_SIZE, JSONBIN_SHARD_COUNT,
+                                 flush_interval, channel, JSONBIN_SYNC_INTERVAL, JSONBIN_OPTIMISTIC_LOCKING,
+                                 JSONBIN_TIMEOUT, JSONBIN_RETRIES, JSONBIN_LOG_RATIO, JSONBIN_SNAPSHOT_DIR,
+                                 JSONBIN_FORMAT)
+        if WRITE_JOURNAL_PATH:
+            from journal import JournaledStorage
+            return JournaledStorage(backend, WRITE_JOURNAL_PATH)
+        return backend
+
+    raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={STORAGE_BACKEND}")
+
+
+# Создаем глобальный экземпляр хранилища
+db_manager = create_storage()
+
+# Единица работы, открытая в текущей задаче
+_current_unit: ContextVar[Optional[UnitOfWork]] = ContextVar("current_unit", default=None)
+
+
+def _storage() -> StorageBackend:
+    """Хранилище для текущего вызова: открытая единица работы или db_manager"""
+    return _current_unit.get() or db_manager
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[UnitOfWork]:
+    """Объединяет чтения и изменения нескольких функций db.py в одно сохранение.
+
+    Изменения сохраняются при выходе из блока (результат — в unit.committed),
+    при исключении отбрасываются. Вложенный блок работает в рамках внешнего.
+    """
+    outer = _current_unit.get()
+    if outer is not None:
+        yield outer
+        return
+
+    unit = UnitOfWork(db_manager)
+    token = _current_unit.set(unit)
+    try:
+        yield unit
+    finally:
+        _current_unit.reset(token)
+    await unit.commit()
 
-if not JSONBIN_API_KEY:
-    raise ValueError("JSONBIN_API_KEY не найден в переменных окружения")
-if not MASTER_BIN_ID:
-    raise ValueError("MASTER_BIN_ID не найден в переменных окружения")
 
-JSONBIN_BASE_URL = "https://api.jsonbin.io/v3/b"
+# --- ФУНКЦИИ ДЛЯ РАБОТЫ С ПОЛЬЗОВАТЕЛЯМИ ---
 
-# Структура данных для хранения в JSON
-INITIAL_DATA_STRUCTURE = {
-    "users": {},
-    "sessions": {},
-    "transactions": {},
-    "debts": {}
-}
+def _new_user(role: str = "user") -> Dict[str, Any]:
+    """Возвращает запись нового пользователя"""
+    return {
+        "role": role,
+        "access_expiry": None,
+        "created_at": datetime.now().isoformat(),
+        "last_active": datetime.now().isoformat()
+    }
 
 
-class JSONBinManager:
-    def __init__(self):
-        self.headers = {
-            "Content-Type": "application/json",
-            "X-Master-Key": JSONBIN_API_KEY,
-        }
-        self.master_bin_id = MASTER_BIN_ID
+async def ensure_user_exists(user_id: int) -> None:
+    """Создает запись пользователя, если её нет"""
+    if await _storage().get("users", user_id) is None:
+        await _storage().put("users", user_id, _new_user())
+        _access_cache.invalidate(user_id)
+
+
+class ActivityTracker:
+    """Копит время последней активности пользователей в памяти и сохраняет его пачкой.
+
+    Нажатия кнопок только обновляют словарь в памяти; раз в interval секунд
+    все накопленные отметки уходят в хранилище одним apply() в фоне.
+    """
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self._pending: Dict[int, str] = {}
+        self._last_flush = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, user_id: int) -> None:
+        self._pending[user_id] = datetime.now().isoformat()
+
+        # Сохраняем в фоне, чтобы обработчик не ждал записи
+        if time.monotonic() - self._last_flush >= self.interval and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self.flush())
+
+    def last_active(self, user_id: int) -> Optional[str]:
+        """Несохраненное время активности пользователя"""
+        return self._pending.get(user_id)
+
+    async def flush(self) -> bool:
+        """Сохраняет накопленные отметки активности"""
+        self._last_flush = time.monotonic()
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return True
+
+        # Изменение несуществующих пользователей хранилище пропускает
+        if await db_manager.apply([
+            storage.update("users", user_id, {"last_active": last_active})
+            for user_id, last_active in pending.items()
+        ]):
+            return True
+
+        # Не удалось сохранить: возвращаем отметки, не затирая более свежие
+        for user_id, last_active in pending.items():
+            self._pending.setdefault(user_id, last_active)
+        return False
 
-    def _load_data(self) -> Dict[str, Any]:
-        """Загружает данные из JSONBin"""
-        try:
-            response = requests.get(f"{JSONBIN_BASE_URL}/{self.master_bin_id}/latest", headers=self.headers)
-            if response.status_code == 200:
-                return response.json()["record"]
-            return INITIAL_DATA_STRUCTURE.copy()
-        except Exception as e:
-            print(f"Ошибка загрузки данных: {e}")
-            return INITIAL_DATA_STRUCTURE.copy()
-
-    def _save_data(self, data: Dict[str, Any]) -> bool:
-        """Сохраняет данные в JSONBin"""
-        try:
-            response = requests.put(f"{JSONBIN_BASE_URL}/{self.master_bin_id}", headers=self.headers, json=data)
-            return response.status_code == 200
-        except Exception as e:
-            print(f"Ошибка сохранения данных: {e}")
-            return False
 
-    def _get_next_id(self, data_type: str) -> int:
-        """Генерирует следующий ID для указанного типа данных"""
-        data = self._load_data()
-        if data_type not in data:
-            return 1
-        existing_ids = [int(id_) for id_ in data[data_type].keys() if id_.isdigit()]
-        return max(existing_ids, default=0) + 1
+_activity_tracker = ActivityTracker(ACTIVITY_FLUSH_INTERVAL)
 
 
-# Создаем глобальный экземпляр менеджера
-db_manager = JSONBinManager()
+async def update_user_activity(user_id: int) -> None:
+    """Запоминает время последней активности пользователя (сохраняется пачкой)"""
+    _activity_tracker.record(user_id)
 
 
-# --- ФУНКЦИИ ДЛЯ РАБОТЫ С ПОЛЬЗОВАТЕЛЯМИ ---
+async def flush_user_activity() -> bool:
+    """Сохраняет накопленное время активности, например перед остановкой бота"""
+    return await _activity_tracker.flush()
 
-def ensure_user_exists(user_id: int) -> None:
-    """Создает запись пользователя, если её нет"""
-    data = db_manager._load_data()
-
-    if str(user_id) not in data["users"]:
-        data["users"][str(user_id)] = {
-            "role": "user",
-            "access_expiry": None,
-            "created_at": datetime.now().isoformat(),
-            "last_active": datetime.now().isoformat()
-        }
-        db_manager._save_data(data)
 
+def _parse_expiry(expiry_str: Optional[str]) -> Optional[datetime]:
+    """Разбирает срок доступа; некорректный срок считается отсутствующим"""
+    if not expiry_str:
+        return None
+    try:
+        return datetime.fromisoformat(expiry_str)
+    except:
+        return None
 
-def update_user_activity(user_id: int) -> None:
-    """Обновляет время последней активности пользователя"""
-    data = db_manager._load_data()
-
-    if str(user_id) in data["users"]:
-        data["users"][str(user_id)]["last_active"] = datetime.now().isoformat()
-        db_manager._save_data(data)
 
+def _access_granted(role: str, expiry: Optional[datetime], now: datetime) -> bool:
+    """Есть ли доступ у пользователя с ролью role и сроком доступа expiry"""
+    return role == "admin" or (expiry is not None and now < expiry)
 
-def get_user_role(user_id: int) -> str:
-    """Возвращает роль пользователя"""
-    data = db_manager._load_data()
-    user = data["users"].get(str(user_id), {})
-    return user.get("role", "user")
 
+class AccessCache:
+    """Роли и разобранные сроки доступа пользователей в памяти.
 
-def check_user_access(user_id: int) -> bool:
-    """Проверяет, есть ли у пользователя доступ"""
-    data = db_manager._load_data()
-    user = data["users"].get(str(user_id), {})
+    Решение о доступе принимается за O(1) без обращения к хранилищу. Запись
+    пользователя перечитывается, когда истекает его срок доступа (его могли
+    продлить) и когда функции управления доступом сбрасывают кэш. Пользователь
+    без записи не кэшируется: запись могла не прочитаться из-за недоступного
+    хранилища, и после его восстановления роль и доступ должны прочитаться заново.
+    """
 
-    if user.get("role") == "admin":
-        return True
+    def __init__(self):
+        self._entries: Dict[int, Tuple[str, Optional[datetime]]] = {}
+
+    async def _entry(self, user_id: int) -> Tuple[str, Optional[datetime]]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            user = await _storage().get("users", user_id)
+            if user is None:
+                return "user", None
+            entry = (user.get("role", "user"), _parse_expiry(user.get("access_expiry")))
+            self._entries[user_id] = entry
+        return entry
+
+    async def role(self, user_id: int) -> str:
+        return (await self._entry(user_id))[0]
+
+    async def has_access(self, user_id: int) -> bool:
+        role, expiry = await self._entry(user_id)
+        if _access_granted(role, expiry, datetime.now()):
+            return True
+        if expiry is None:
+            return False
 
-    expiry_str = user.get("access_expiry")
-    if not expiry_str:
+        # Срок истек: один раз перечитываем запись, дальше помним, что доступа нет
+        self.invalidate(user_id)
+        role, expiry = await self._entry(user_id)
+        if _access_granted(role, expiry, datetime.now()):
+            return True
+        if user_id in self._entries:
+            self._entries[user_id] = (role, None)
         return False
 
-    try:
-        expiry = datetime.fromisoformat(expiry_str)
-        return datetime.now() < expiry
-    except:
-        return False
+    def invalidate(self, user_id: int = None) -> None:
+        """Сбрасывает запись пользователя или, без user_id, весь кэш"""
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
 
 
-def update_user_access(user_id: int, has_access: bool, days: int = 30) -> bool:
+_access_cache = AccessCache()
+
+
+async def get_user_role(user_id: int) -> str:
+    """Возвращает роль пользователя"""
+    return await _access_cache.role(user_id)
+
+
+async def check_user_access(user_id: int) -> bool:
+    """Проверяет, есть ли у пользователя доступ"""
+    return await _access_cache.has_access(user_id)
+
+
+async def update_user_access(user_id: int, has_access: bool, days: int = 30) -> bool:
     """Обновляет доступ пользователя"""
-    data = db_manager._load_data()
-
-    if str(user_id) not in data["users"]:
-        data["users"][str(user_id)] = {
-            "role": "user",
-            "access_expiry": None,
-            "created_at": datetime.now().isoformat(),
-            "last_active": datetime.now().isoformat()
-        }
+    user = await _storage().get("users", user_id) or _new_user()
 
     if has_access:
         expiry = datetime.now() + timedelta(days=days)
-        data["users"][str(user_id)]["access_expiry"] = expiry.isoformat()
+        user["access_expiry"] = expiry.isoformat()
     else:
-        data["users"][str(user_id)]["access_expiry"] = None
+        user["access_expiry"] = None
 
-    return db_manager._save_data(data)
+    try:
+        return await _storage().put("users", user_id, user)
+    finally:
+        _access_cache.invalidate(user_id)
 
 
-def add_admin(user_id: int) -> bool:
+async def add_admin(user_id: int) -> bool:
     """Добавляет администратора"""
-    data = db_manager._load_data()
-
-    if str(user_id) not in data["users"]:
-        data["users"][str(user_id)] = {
-            "role": "admin",
-            "access_expiry": None,
-            "created_at": datetime.now().isoformat(),
-            "last_active": datetime.now().isoformat()
-        }
-    else:
-        data["users"][str(user_id)]["role"] = "admin"
+    user = await _storage().get("users", user_id) or _new_user("admin")
+    user["role"] = "admin"
 
-    return db_manager._save_data(data)
+    try:
+        return await _storage().put("users", user_id, user)
+    finally:
+        _access_cache.invalidate(user_id)
 
 
-def remove_admin(user_id: int) -> bool:
+async def remove_admin(user_id: int) -> bool:
     """Удаляет администратора"""
-    data = db_manager._load_data()
-
-    if str(user_id) in data["users"] and str(user_id) != "8382571809":
-        data["users"][str(user_id)]["role"] = "user"
-        data["users"][str(user_id)]["access_expiry"] = None
-        return db_manager._save_data(data)
+    if str(user_id) != "8382571809" and await _storage().get("users", user_id) is not None:
+        try:
+            return await _storage().update("users", user_id, {"role": "user", "access_expiry": None})
+        finally:
+            _access_cache.invalidate(user_id)
 
     return False
 
 
-def get_all_users() -> List[Dict[str, Any]]:
+async def get_all_users() -> List[Dict[str, Any]]:
     """Возвращает список всех пользователей"""
-    data = db_manager._load_data()
     users = []
 
-    for user_id_str, user_data in data["users"].items():
+    for user_id, user_data in await _storage().find("users"):
         users.append({
-            "user_id": int(user_id_str),
+            "user_id": user_id,
             "role": user_data.get("role", "user"),
             "access_expiry": user_data.get("access_expiry"),
             "created_at": user_data.get("created_at"),
-            "last_active": user_data.get("last_active")
+            "last_active": _activity_tracker.last_active(user_id) or user_data.get("last_active")
         })
 
     return users
 
 
-def grant_access_to_all() -> bool:
+# Аудитории массовой рассылки
+BROADCAST_AUDIENCES = ("all", "access", "no_access")
+
+
+async def get_broadcast_audience(audience: str) -> List[int]:
+    """Возвращает ID получателей рассылки: все, с доступом или без доступа.
+    Доступ проверяется за один проход по одной выборке пользователей."""
+    if audience not in BROADCAST_AUDIENCES:
+        return []
+
+    now = datetime.now()
+    recipients = []
+
+    for user_id, user_data in await _storage().find("users"):
+        if audience != "all":
+            has_access = _access_granted(user_data.get("role", "user"),
+                                         _parse_expiry(user_data.get("access_expiry")), now)
+            if has_access != (audience == "access"):
+                continue
+        recipients.append(user_id)
+
+    return recipients
+
+
+async def grant_access_to_all() -> bool:
     """Открывает доступ всем пользователям на 30 дней"""
-    data = db_manager._load_data()
     expiry = (datetime.now() + timedelta(days=30)).isoformat()
 
     try:
-        for user_id_str, user_data in data["users"].items():
-            if user_data.get("role") != "admin":
-                data["users"][user_id_str]["access_expiry"] = expiry
-
-        return db_manager._save_data(data)
+        mutations = [
+            storage.update("users", user_id, {"access_expiry": expiry})
+            for user_id, user_data in await _storage().find("users")
+            if user_data.get("role") != "admin"
+        ]
+        return await _storage().apply(mutations)
     except Exception as e:
         print(f"Ошибка при открытии доступа всем: {e}")
         return False
+    finally:
+        _access_cache.invalidate()
 
 
-def revoke_temporary_access() -> bool:
+async def revoke_temporary_access() -> bool:
     """Закрывает доступ всем пользователям без админки"""
-    data = db_manager._load_data()
-
     try:
-        for user_id_str, user_data in data["users"].items():
-            if user_data.get("role") != "admin":
-                data["users"][user_id_str]["access_expiry"] = None
-
-        return db_manager._save_data(data)
+        mutations = [
+            storage.update("users", user_id, {"access_expiry": None})
+            for user_id, user_data in await _storage().find("users")
+            if user_data.get("role") != "admin"
+        ]
+        return await _storage().apply(mutations)
     except Exception as e:
         print(f"Ошибка при закрытии доступа всем: {e}")
         return False
+    finally:
+        _access_cache.invalidate()
+
+
+# --- ФУНКЦИИ ДЛЯ РАССЫЛОК ---
+
+# Статусы заданий рассылки: в очереди, отправляется, завершено
+BROADCAST_STATUSES = ("queued", "running", "finished")
+
+
+async def create_broadcast_job(admin_id: int, progress_message_id: int, text: str, recipients: List[int]) -> int:
+    """Ставит рассылку в очередь и возвращает ID задания"""
+    job = {
+        "admin_id": admin_id,
+        "progress_message_id": progress_message_id,
+        "text": text,
+        # Списки получателей нужны, только пока задание выполняется: завершенное задание
+        # хранит лишь их число total
+        "recipients": list(recipients),
+        "total": len(recipients),
+        # Получатели до cursor обработаны; done — обработанные номера после cursor
+        "cursor": 0,
+        "done": [],
+        "sent": 0,
+        "blocked": 0,
+        "failed": 0,
+        "status": "queued",
+        "created_at": datetime.now().isoformat(),
+        "started_at": None,
+        "finished_at": None
+    }
+    job_id = await _storage().next_id("broadcasts", job)
+    await _storage().put("broadcasts", job_id, job)
+    return job_id
+
+
+async def get_broadcast_job(job_id: int) -> Optional[Dict[str, Any]]:
+    """Возвращает задание рассылки с его ID"""
+    job = await _storage().get("broadcasts", job_id)
+    return {"id": job_id, **job} if job is not None else None
+
+
+async def update_broadcast_job(job_id: int, fields: Dict[str, Any]) -> bool:
+    """Сохраняет ход или статус задания рассылки"""
+    return await _storage().update("broadcasts", job_id, fields)
+
+
+async def finish_broadcast_job(job_id: int, finished_at: str) -> bool:
+    """Отмечает задание завершенным и убирает из него списки получателей"""
+    return await _storage().update("broadcasts", job_id, {"status": "finished", "finished_at": finished_at,
+                                                          "recipients": [], "done": []})
+
+
+async def get_pending_broadcast_jobs() -> List[Dict[str, Any]]:
+    """Незавершенные задания в порядке постановки в очередь"""
+    jobs = [
+        {"id": job_id, **job}
+        for status in ("running", "queued")
+        for job_id, job in await _storage().find("broadcasts", {"status": status})
+    ]
+    return sorted(jobs, key=lambda job: job["id"])
+
+
+async def get_broadcast_jobs(limit: int = 5) -> List[Dict[str, Any]]:
+    """Последние задания рассылки, новые первыми"""
+    rows = await _storage().find("broadcasts", order_by="created_at", descending=True, limit=limit)
+    return [{"id": job_id, **job} for job_id, job in rows]
 
 
 # --- ФУНКЦИИ ДЛЯ РАБОТЫ С СЕССИЯМИ ---
 
-def add_session(user_id: int, name: str, budget: float, currency: str) -> int:
-    """Создает новую сессию и возвращает её ID"""
-    data = db_manager._load_data()
-    session_id = db_manager._get_next_id("sessions")
+def _touch_session(session_id: int) -> storage.Mutation:
+    """Изменение, обновляющее время последнего изменения сессии"""
+    return storage.update("sessions", session_id, {"last_updated": datetime.now().isoformat()})
+
+
+# --- АГРЕГАТЫ СЕССИЙ ---
+
+# Итоги, которые хранятся в записи сессии в поле "stats" и обновляются
+# при каждом изменении транзакций и долгов
+SESSION_STATS_FIELDS = ("total_sales", "total_expenses", "sales_count", "owed_to_me", "i_owe")
+
+# Дневная статистика хранится в поле "daily": дата (YYYY-MM-DD) -> счетчики дня
+DAILY_STATS_FIELDS = ("sales_count", "expenses_count", "total_sales", "total_expenses")
+
+
+def _transaction_stats(trans_data: Dict[str, Any]) -> Dict[str, float]:
+    """Вклад транзакции в итоги сессии"""
+    if trans_data.get("type") == "sale":
+        return {
+            "total_sales": trans_data.get("amount", 0),
+            "total_expenses": trans_data.get("expense_amount", 0),
+            "sales_count": 1
+        }
+    if trans_data.get("type") == "expense":
+        return {"total_expenses": trans_data.get("amount", 0)}
+    return {}
+
+
+def _transaction_daily(trans_data: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    """Вклад транзакции в дневную статистику сессии"""
+    day = (trans_data.get("created_at") or "")[:10]
+    if trans_data.get("type") == "sale":
+        return {day: {
+            "sales_count": 1,
+            "total_sales": trans_data.get("amount", 0),
+            "total_expenses": trans_data.get("expense_amount", 0)
+        }}
+    if trans_data.get("type") == "expense":
+        return {day: {"expenses_count": 1, "total_expenses": trans_data.get("amount", 0)}}
+    return {}
+
+
+def _debt_stats(debt_data: Dict[str, Any]) -> Dict[str, float]:
+    """Вклад долга в итоги сессии: учитываются только непогашенные"""
+    if debt_data.get("is_repaid", False) or debt_data.get("type") not in ("owed_to_me", "i_owe"):
+        return {}
+    return {debt_data["type"]: debt_data.get("amount", 0)}
+
+
+def _stats_delta(old: Dict[str, float], new: Dict[str, float]) -> Dict[str, float]:
+    """Разница вкладов записи до и после изменения"""
+    delta = {}
+    for field in set(old) | set(new):
+        change = new.get(field, 0) - old.get(field, 0)
+        if change:
+            delta[field] = change
+    return delta
+
+
+def _daily_delta(old: Dict[str, Dict[str, float]], new: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """Разница вкладов записи в дневную статистику до и после изменения"""
+    delta = {}
+    for day in set(old) | set(new):
+        day_delta = _stats_delta(old.get(day, {}), new.get(day, {}))
+        if day_delta:
+            delta[day] = day_delta
+    return delta
+
 
-    data["sessions"][str(session_id)] = {
+def _transaction_changes(session_id: int, old: Optional[Dict[str, Any]],
+                         new: Optional[Dict[str, Any]]) -> List[storage.Mutation]:
+    """Изменения итогов и дневной статистики сессии при замене транзакции old на new"""
+    old, new = old or {}, new or {}
+    mutations = []
+
+    stats = _stats_delta(_transaction_stats(old), _transaction_stats(new))
+    if stats:
+        mutations.append(storage.increment("sessions", session_id, "stats", stats))
+
+    daily = _daily_delta(_transaction_daily(old), _transaction_daily(new))
+    if daily:
+        mutations.append(storage.increment("sessions", session_id, "daily", daily))
+
+    return mutations
+
+
+def _debt_changes(session_id: int, old: Optional[Dict[str, Any]],
+                  new: Optional[Dict[str, Any]]) -> List[storage.Mutation]:
+    """Изменения итогов сессии при замене долга old на new"""
+    stats = _stats_delta(_debt_stats(old or {}), _debt_stats(new or {}))
+    return [storage.increment("sessions", session_id, "stats", stats)] if stats else []
+
+
+async def _compute_session_aggregates(session_id: int) -> Dict[str, Any]:
+    """Считает итоги и дневную статистику сессии заново по всем транзакциям и долгам"""
+    stats = dict.fromkeys(SESSION_STATS_FIELDS, 0)
+    daily = {}
+
+    for _, trans_data in await _storage().find("transactions", {"session_id": session_id}):
+        for field, value in _transaction_stats(trans_data).items():
+            stats[field] += value
+        for day, counters in _transaction_daily(trans_data).items():
+            bucket = daily.setdefault(day, dict.fromkeys(DAILY_STATS_FIELDS, 0))
+            for field, value in counters.items():
+                bucket[field] += value
+
+    for _, debt_data in await _storage().find("debts", {"session_id": session_id}):
+        for field, value in _debt_stats(debt_data).items():
+            stats[field] += value
+
+    return {"stats": stats, "daily": daily}
+
+
+def _counters_match(stored: Dict[str, Any], actual: Dict[str, Any]) -> bool:
+    """Сравнивает счетчики с учетом погрешности float; отсутствующий счетчик равен нулю"""
+    for key in set(stored) | set(actual):
+        stored_value, actual_value = stored.get(key, 0), actual.get(key, 0)
+        if isinstance(stored_value, dict) or isinstance(actual_value, dict):
+            if not _counters_match(stored_value or {}, actual_value or {}):
+                return False
+        elif abs(stored_value - actual_value) > 1e-6:
+            return False
+    return True
+
+
+async def rebuild_session_stats(session_id: int) -> Optional[Dict[str, Any]]:
+    """Пересчитывает и сохраняет итоги и дневную статистику сессии"""
+    if await _storage().get("sessions", session_id) is None:
+        return None
+
+    aggregates = await _compute_session_aggregates(session_id)
+    # last_updated меняется вместе с итогами, чтобы кэш аналитики не отдал старые дневные данные
+    await _storage().apply([storage.update("sessions", session_id, aggregates), _touch_session(session_id)])
+    return aggregates
+
+
+async def verify_session_stats(session_id: int) -> bool:
+    """Сверяет сохраненные итоги сессии с пересчетом и исправляет их при расхождении"""
+    session_data = await _storage().get("sessions", session_id)
+    if session_data is None:
+        return False
+
+    actual = await _compute_session_aggregates(session_id)
+    stored = {field: session_data.get(field) or {} for field in actual}
+    if _counters_match(stored, actual):
+        return True
+
+    print(f"Итоги сессии {session_id} разошлись с данными, пересчитываем")
+    await _storage().apply([storage.update("sessions", session_id, actual), _touch_session(session_id)])
+    return False
+
+
+async def add_session(user_id: int, name: str, budget: float, currency: str) -> int:
+    """Создает новую сессию и возвращает её ID"""
+    session = {
         "user_id": user_id,
         "name": name[:50],
         "budget": float(budget),
@@ -235,68 +628,56 @@ def add_session(user_id: int, name: str, budget: float, currency: str) -> int:
         "is_active": True,
         "created_at": datetime.now().isoformat(),
         "closed_at": None,
-        "last_updated": datetime.now().isoformat()
+        "last_updated": datetime.now().isoformat(),
+        "stats": dict.fromkeys(SESSION_STATS_FIELDS, 0),
+        "daily": {}
     }
+    session_id = await _storage().next_id("sessions", session)
+
+    await _storage().put("sessions", session_id, session)
 
-    db_manager._save_data(data)
     return session_id
 
 
-def get_user_sessions(user_id: int) -> List[tuple]:
+async def get_user_sessions(user_id: int) -> List[tuple]:
     """Возвращает список сессий пользователя"""
-    data = db_manager._load_data()
     sessions = []
 
-    for session_id_str, session_data in data["sessions"].items():
-        if session_data.get("user_id") == user_id:
-            sessions.append((
-                int(session_id_str),
-                session_data["name"],
-                session_data["budget"],
-                session_data["currency"],
-                session_data["is_active"]
-            ))
+    for session_id, session_data in await _storage().find("sessions", {"user_id": user_id}):
+        sessions.append((
+            session_id,
+            session_data["name"],
+            session_data["budget"],
+            session_data["currency"],
+            session_data["is_active"]
+        ))
 
     return sorted(sessions, key=lambda x: x[0], reverse=True)
 
 
-def get_session_details(session_id: int) -> Optional[Dict[str, Any]]:
-    """Возвращает детали сессии с расчетами"""
-    data = db_manager._load_data()
-    session_data = data["sessions"].get(str(session_id))
-
-    if not session_data:
-        return None
-
-    # Получаем все транзакции для сессии
-    transactions = [
-        t for t in data["transactions"].values()
-        if t.get("session_id") == session_id
-    ]
+async def _load_session(session_id: int) -> Optional[Dict[str, Any]]:
+    """Возвращает запись сессии вместе с итогами и дневной статистикой"""
+    session_data = await _storage().get("sessions", session_id)
 
-    # Получаем все долги для сессии
-    debts = [
-        d for d in data["debts"].values()
-        if d.get("session_id") == session_id
-    ]
+    # Для сессий, созданных до появления итогов, считаем их один раз
+    if session_data and (session_data.get("stats") is None or session_data.get("daily") is None):
+        session_data.update(await rebuild_session_stats(session_id))
 
-    # Расчеты
-    sales = [t for t in transactions if t.get("type") == "sale"]
-    expenses = [t for t in transactions if t.get("type") == "expense"]
+    return session_data
 
-    total_sales = sum(t.get("amount", 0) for t in sales)
-    total_expenses = sum(t.get("expense_amount", 0) for t in sales) + sum(t.get("amount", 0) for t in expenses)
 
-    debts_owed_to_me = [d for d in debts if d.get("type") == "owed_to_me" and not d.get("is_repaid", False)]
-    debts_i_owe = [d for d in debts if d.get("type") == "i_owe" and not d.get("is_repaid", False)]
+def _session_details(session_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Детали сессии по сохраненным итогам"""
+    stats = session_data["stats"]
 
-    owed_to_me = sum(d.get("amount", 0) for d in debts_owed_to_me)
-    i_owe = sum(d.get("amount", 0) for d in debts_i_owe)
+    total_sales = stats.get("total_sales", 0)
+    total_expenses = stats.get("total_expenses", 0)
+    sales_count = stats.get("sales_count", 0)
 
     balance = total_sales - total_expenses
 
     # Рассчитываем средний чек
-    avg_check = total_sales / len(sales) if sales else 0
+    avg_check = total_sales / sales_count if sales_count else 0
 
     return {
         "name": session_data["name"],
@@ -306,48 +687,53 @@ def get_session_details(session_id: int) -> Optional[Dict[str, Any]]:
         "balance": balance,
         "total_sales": total_sales,
         "total_expenses": total_expenses,
-        "sales_count": len(sales),
-        "owed_to_me": owed_to_me,
-        "i_owe": i_owe,
+        "sales_count": sales_count,
+        "owed_to_me": stats.get("owed_to_me", 0),
+        "i_owe": stats.get("i_owe", 0),
         "avg_check": avg_check,
         "created_at": session_data.get("created_at"),
         "last_updated": session_data.get("last_updated")
     }
 
 
-def close_session(session_id: int) -> bool:
-    """Закрывает сессию"""
-    data = db_manager._load_data()
+async def get_session_details(session_id: int) -> Optional[Dict[str, Any]]:
+    """Возвращает детали сессии с расчетами"""
+    session_data = await _load_session(session_id)
 
-    if str(session_id) in data["sessions"]:
-        data["sessions"][str(session_id)]["is_active"] = False
-        data["sessions"][str(session_id)]["closed_at"] = datetime.now().isoformat()
-        data["sessions"][str(session_id)]["last_updated"] = datetime.now().isoformat()
-        return db_manager._save_data(data)
+    if not session_data:
+        return None
+
+    return _session_details(session_data)
+
+
+async def close_session(session_id: int) -> bool:
+    """Закрывает сессию"""
+    if await _storage().get("sessions", session_id) is not None:
+        return await _storage().update("sessions", session_id, {
+            "is_active": False,
+            "closed_at": datetime.now().isoformat(),
+            "last_updated": datetime.now().isoformat()
+        })
 
     return False
 
 
-def update_session(session_id: int, field: str, value: Any) -> bool:
+async def update_session(session_id: int, field: str, value: Any) -> bool:
     """Обновляет поле сессии"""
-    data = db_manager._load_data()
-
-    if str(session_id) in data["sessions"]:
-        data["sessions"][str(session_id)][field] = value
-        data["sessions"][str(session_id)]["last_updated"] = datetime.now().isoformat()
-        return db_manager._save_data(data)
+    if await _storage().get("sessions", session_id) is not None:
+        return await _storage().update("sessions", session_id, {
+            field: value,
+            "last_updated": datetime.now().isoformat()
+        })
 
     return False
 
 
 # --- ФУНКЦИИ ДЛЯ ТРАНЗАКЦИЙ ---
 
-def add_transaction(session_id: int, trans_type: str, amount: float, expense_amount: float, description: str) -> int:
+async def add_transaction(session_id: int, trans_type: str, amount: float, expense_amount: float, description: str) -> int:
     """Добавляет транзакцию (продажу или затрату)"""
-    data = db_manager._load_data()
-    transaction_id = db_manager._get_next_id("transactions")
-
-    data["transactions"][str(transaction_id)] = {
+    transaction = {
         "session_id": session_id,
         "type": trans_type,
         "amount": float(amount),
@@ -356,52 +742,57 @@ def add_transaction(session_id: int, trans_type: str, amount: float, expense_amo
         "created_at": datetime.now().isoformat(),
         "updated_at": datetime.now().isoformat()
     }
+    transaction_id = await _storage().next_id("transactions", transaction)
 
-    # Обновляем время последнего изменения сессии
-    if str(session_id) in data["sessions"]:
-        data["sessions"][str(session_id)]["last_updated"] = datetime.now().isoformat()
+    await _storage().apply([
+        storage.put("transactions", transaction_id, transaction),
+        # Обновляем время последнего изменения сессии и её итоги
+        _touch_session(session_id),
+        *_transaction_changes(session_id, None, transaction)
+    ])
 
-    db_manager._save_data(data)
     return transaction_id
 
 
-def get_transactions_list(session_id: int, trans_type: str = None, search_query: str = None, limit: int = None) -> List[Dict[str, Any]]:
-    """Возвращает список транзакций с фильтрацией"""
-    data = db_manager._load_data()
-    transactions = []
+def _format_transaction(trans_id: int, trans_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Транзакция в виде для списков и аналитики"""
+    # Форматируем дату для отображения
+    try:
+        date_obj = datetime.fromisoformat(trans_data["created_at"])
+        formatted_date = date_obj.strftime("%d.%m.%Y %H:%M")
+    except:
+        formatted_date = trans_data.get("created_at", "")
 
-    for trans_id_str, trans_data in data["transactions"].items():
-        if trans_data.get("session_id") != session_id:
-            continue
+    return {
+        "id": trans_id,
+        "type": trans_data.get("type"),
+        "amount": trans_data.get("amount", 0),
+        "expense_amount": trans_data.get("expense_amount", 0),
+        "description": trans_data.get("description", ""),
+        "date": formatted_date,
+        "created_at": trans_data.get("created_at"),
+        "profit": trans_data.get("amount", 0) - trans_data.get("expense_amount", 0)
+    }
 
-        if trans_type and trans_data.get("type") != trans_type:
-            continue
 
+async def get_transactions_list(session_id: int, trans_type: str = None, search_query: str = None, limit: int = None) -> List[Dict[str, Any]]:
+    """Возвращает список транзакций с фильтрацией"""
+    where = {"session_id": session_id}
+    if trans_type:
+        where["type"] = trans_type
+
+    # Сортируем по дате (новые сверху); при поиске лимит применяем после фильтрации
+    rows = await _storage().find("transactions", where, order_by="created_at", descending=True,
+                                 limit=None if search_query else limit)
+    transactions = []
+
+    for trans_id, trans_data in rows:
         if search_query:
             desc = trans_data.get("description", "").lower()
             if search_query.lower() not in desc:
                 continue
 
-        # Форматируем дату для отображения
-        try:
-            date_obj = datetime.fromisoformat(trans_data["created_at"])
-            formatted_date = date_obj.strftime("%d.%m.%Y %H:%M")
-        except:
-            formatted_date = trans_data.get("created_at", "")
-
-        transactions.append({
-            "id": int(trans_id_str),
-            "type": trans_data.get("type"),
-            "amount": trans_data.get("amount", 0),
-            "expense_amount": trans_data.get("expense_amount", 0),
-            "description": trans_data.get("description", ""),
-            "date": formatted_date,
-            "created_at": trans_data.get("created_at"),
-            "profit": trans_data.get("amount", 0) - trans_data.get("expense_amount", 0)
-        })
-
-    # Сортируем по дате (новые сверху)
-    transactions.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+        transactions.append(_format_transaction(trans_id, trans_data))
 
     if limit:
         transactions = transactions[:limit]
@@ -409,61 +800,59 @@ def get_transactions_list(session_id: int, trans_type: str = None, search_query:
     return transactions
 
 
-def update_transaction(transaction_id: int, field: str, new_value: Any) -> bool:
+async def update_transaction(transaction_id: int, field: str, new_value: Any) -> bool:
     """Обновляет поле транзакции"""
-    data = db_manager._load_data()
+    trans_data = await _storage().get("transactions", transaction_id)
 
-    if str(transaction_id) not in data["transactions"]:
+    if trans_data is None:
         return False
 
     if field in ["amount", "expense_amount"]:
         new_value = float(new_value)
 
-    data["transactions"][str(transaction_id)][field] = new_value
-    data["transactions"][str(transaction_id)]["updated_at"] = datetime.now().isoformat()
+    mutations = [storage.update("transactions", transaction_id, {
+        field: new_value,
+        "updated_at": datetime.now().isoformat()
+    })]
 
-    # Обновляем время сессии
-    session_id = data["transactions"][str(transaction_id)].get("session_id")
-    if session_id and str(session_id) in data["sessions"]:
-        data["sessions"][str(session_id)]["last_updated"] = datetime.now().isoformat()
+    # Обновляем время сессии и её итоги
+    session_id = trans_data.get("session_id")
+    if session_id:
+        mutations.append(_touch_session(session_id))
+        mutations += _transaction_changes(session_id, trans_data, {**trans_data, field: new_value})
 
-    return db_manager._save_data(data)
+    return await _storage().apply(mutations)
 
 
-def delete_transaction(transaction_id: int) -> bool:
+async def delete_transaction(transaction_id: int) -> bool:
     """Удаляет транзакцию"""
-    data = db_manager._load_data()
+    trans_data = await _storage().get("transactions", transaction_id)
 
-    if str(transaction_id) in data["transactions"]:
-        # Получаем session_id перед удалением
-        session_id = data["transactions"][str(transaction_id)].get("session_id")
+    if trans_data is not None:
+        mutations = [storage.delete("transactions", transaction_id)]
 
-        del data["transactions"][str(transaction_id)]
+        # Обновляем время сессии и её итоги
+        session_id = trans_data.get("session_id")
+        if session_id:
+            mutations.append(_touch_session(session_id))
+            mutations += _transaction_changes(session_id, trans_data, None)
 
-        # Обновляем время сессии
-        if session_id and str(session_id) in data["sessions"]:
-            data["sessions"][str(session_id)]["last_updated"] = datetime.now().isoformat()
-
-        return db_manager._save_data(data)
+        return await _storage().apply(mutations)
 
     return False
 
 
-def get_transaction_type(transaction_id: int) -> Optional[str]:
+async def get_transaction_type(transaction_id: int) -> Optional[str]:
     """Возвращает тип транзакции"""
-    data = db_manager._load_data()
-    trans_data = data["transactions"].get(str(transaction_id))
+    trans_data = await _storage().get("transactions", transaction_id)
     return trans_data.get("type") if trans_data else None
 
 
 # --- ФУНКЦИИ ДЛЯ ДОЛГОВ ---
 
-def add_debt(session_id: int, debt_type: str, person_name: str, amount: float, description: str = "") -> int:
+async def add_debt(session_id: int, debt_type: str, person_name: str, amount: float, description: str = "") -> int:
     """Добавляет запись о долге"""
-    data = db_manager._load_data()
-    debt_id = db_manager._get_next_id("debts")
-
-    data["debts"][str(debt_id)] = {
+    debt = {
         "session_id": session_id,
         "type": debt_type,
         "person_name": person_name[:50],
@@ -473,27 +862,29 @@ def add_debt(session_id: int, debt_type: str, person_name: str, amount: float, d
         "created_at": datetime.now().isoformat(),
         "updated_at": datetime.now().isoformat()
     }
+    debt_id = await _storage().next_id("debts", debt)
 
-    # Обновляем время сессии
-    if str(session_id) in data["sessions"]:
-        data["sessions"][str(session_id)]["last_updated"] = datetime.now().isoformat()
+    await _storage().apply([
+        storage.put("debts", debt_id, debt),
+        # Обновляем время сессии и её итоги
+        _touch_session(session_id),
+        *_debt_changes(session_id, None, debt)
+    ])
 
-    db_manager._save_data(data)
     return debt_id
 
 
-def get_debts_list(session_id: int, debt_type: str = None, search_query: str = None, limit: int = None) -> List[Dict[str, Any]]:
+async def get_debts_list(session_id: int, debt_type: str = None, search_query: str = None, limit: int = None) -> List[Dict[str, Any]]:
     """Возвращает список долгов с фильтрацией"""
-    data = db_manager._load_data()
-    debts = []
-
-    for debt_id_str, debt_data in data["debts"].items():
-        if debt_data.get("session_id") != session_id:
-            continue
+    where = {"session_id": session_id}
+    if debt_type:
+        where["type"] = debt_type
 
-        if debt_type and debt_data.get("type") != debt_type:
-            continue
+    rows = await _storage().find("debts", where, order_by="created_at", descending=True,
+                                 limit=None if search_query else limit)
+    debts = []
 
+    for debt_id, debt_data in rows:
         if search_query:
             person = debt_data.get("person_name", "").lower()
             desc = debt_data.get("description", "").lower()
@@ -508,7 +899,7 @@ def get_debts_list(session_id: int, debt_type: str = None, search_query: str = N
             formatted_date = debt_data.get("created_at", "")
 
         debts.append({
-            "id": int(debt_id_str),
+            "id": debt_id,
             "type": debt_data.get("type"),
             "person_name": debt_data.get("person_name", ""),
             "amount": debt_data.get("amount", 0),
@@ -518,19 +909,17 @@ def get_debts_list(session_id: int, debt_type: str = None, search_query: str = N
             "created_at": debt_data.get("created_at")
         })
 
-    debts.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-
     if limit:
         debts = debts[:limit]
 
     return debts
 
 
-def update_debt(debt_id: int, field: str, new_value: Any) -> bool:
+async def update_debt(debt_id: int, field: str, new_value: Any) -> bool:
     """Обновляет поле долга"""
-    data = db_manager._load_data()
+    debt_data = await _storage().get("debts", debt_id)
 
-    if str(debt_id) not in data["debts"]:
+    if debt_data is None:
         return False
 
     if field == "amount":
@@ -538,87 +927,265 @@ def update_debt(debt_id: int, field: str, new_value: Any) -> bool:
     elif field == "is_repaid":
         new_value = bool(int(new_value)) if isinstance(new_value, (int, str)) else bool(new_value)
 
-    data["debts"][str(debt_id)][field] = new_value
-    data["debts"][str(debt_id)]["updated_at"] = datetime.now().isoformat()
+    mutations = [storage.update("debts", debt_id, {
+        field: new_value,
+        "updated_at": datetime.now().isoformat()
+    })]
 
-    # Обновляем время сессии
-    session_id = data["debts"][str(debt_id)].get("session_id")
-    if session_id and str(session_id) in data["sessions"]:
-        data["sessions"][str(session_id)]["last_updated"] = datetime.now().isoformat()
+    # Обновляем время сессии и её итоги
+    session_id = debt_data.get("session_id")
+    if session_id:
+        mutations.append(_touch_session(session_id))
+        mutations += _debt_changes(session_id, debt_data, {**debt_data, field: new_value})
 
-    return db_manager._save_data(data)
+    return await _storage().apply(mutations)
 
 
-def delete_debt(debt_id: int) -> bool:
+async def delete_debt(debt_id: int) -> bool:
     """Удаляет запись о долге"""
-    data = db_manager._load_data()
-
-    if str(debt_id) in data["debts"]:
-        # Получаем session_id перед удалением
-        session_id = data["debts"][str(debt_id)].get("session_id")
+    debt_data = await _storage().get("debts", debt_id)
 
-        del data["debts"][str(debt_id)]
+    if debt_data is not None:
+        mutations = [storage.delete("debts", debt_id)]
 
-        # Обновляем время сессии
-        if session_id and str(session_id) in data["sessions"]:
-            data["sessions"][str(session_id)]["last_updated"] = datetime.now().isoformat()
+        # Обновляем время сессии и её итоги
+        session_id = debt_data.get("session_id")
+        if session_id:
+            mutations.append(_touch_session(session_id))
+            mutations += _debt_changes(session_id, debt_data, None)
 
-        return db_manager._save_data(data)
+        return await _storage().apply(mutations)
 
     return False
 
 
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ АНАЛИТИКИ ИНТЕРНЕТ-ПРОДАЖ ---
 
-def get_daily_statistics(session_id: int, days: int = 7) -> List[Dict[str, Any]]:
-    """Возвращает статистику по дням за последние N дней"""
-    data = db_manager._load_data()
+class SessionAnalytics:
+    """Аналитика сессии по одному снимку данных.
+
+    Сессия и её транзакции читаются один раз, а за один проход по транзакциям
+    собираются списки продаж и затрат, категории затрат, расходы на рекламу
+    и транзакции по дням. Все разделы сводки строятся из этих накоплений.
+    """
+
+    def __init__(self, session_id: int, session_data: Optional[Dict[str, Any]],
+                 rows: List[Tuple[int, Dict[str, Any]]]):
+        self.session_id = session_id
+        self.session_data = session_data
+        self.daily = session_data["daily"] if session_data else {}
+
+        # Списки идут от новых транзакций к старым, как в get_transactions_list
+        self.sales: List[Dict[str, Any]] = []
+        self.expenses: List[Dict[str, Any]] = []
+        self.expense_categories: Dict[str, float] = {}
+        self.ad_expenses = 0
+        self._day_rows: Dict[str, List[Tuple[int, Dict[str, Any]]]] = {}
+        # Уже посчитанные разделы: снимок неизменен, поэтому считаем каждый раз только однажды
+        self._results: Dict[Any, Any] = {}
+
+        for trans_id, trans_data in rows:
+            trans_type = trans_data.get("type")
+            if trans_type == "sale":
+                self.sales.append(_format_transaction(trans_id, trans_data))
+            elif trans_type == "expense":
+                expense = _format_transaction(trans_id, trans_data)
+                self.expenses.append(expense)
+
+                category = _expense_category(expense["description"])
+                self.expense_categories[category] = self.expense_categories.get(category, 0) + expense["amount"]
+                if _is_ad_expense(expense["description"]):
+                    self.ad_expenses += expense["amount"]
+            else:
+                continue
 
-    daily_stats = []
-    today = datetime.now().date()
+            self._day_rows.setdefault((trans_data.get("created_at") or "")[:10], []).append((trans_id, trans_data))
 
-    for i in range(days):
-        date = today - timedelta(days=i)
-        date_start = datetime.combine(date, datetime.min.time())
-        date_end = datetime.combine(date, datetime.max.time())
+    def _cached(self, key: Any, compute):
+        """Возвращает копию раздела, считая его при первом обращении"""
+        if key not in self._results:
+            self._results[key] = compute()
+        return copy.deepcopy(self._results[key])
 
-        daily_sales = []
-        daily_expenses = []
+    def details(self) -> Optional[Dict[str, Any]]:
+        return _session_details(self.session_data) if self.session_data else None
 
-        for trans_id_str, trans_data in data["transactions"].items():
-            if trans_data.get("session_id") != session_id:
-                continue
+    def daily_statistics(self, days: int = 7, include_transactions: bool = False) -> List[Dict[str, Any]]:
+        return self._cached(("daily", days, include_transactions),
+                            lambda: self._daily_statistics(days, include_transactions))
+
+    def _daily_statistics(self, days: int, include_transactions: bool) -> List[Dict[str, Any]]:
+        day_transactions = None
+        if include_transactions:
+            # Внутри дня — продажи, затем затраты, от ранних к поздним
+            day_transactions = {}
+            for day, day_rows in self._day_rows.items():
+                day_rows = day_rows[::-1]
+                day_transactions[day] = [t for _, t in day_rows if t.get("type") == "sale"] + \
+                                        [t for _, t in day_rows if t.get("type") == "expense"]
+        return _daily_statistics(self.daily, days, day_transactions)
+
+    def sales_velocity(self) -> Dict[str, Any]:
+        return self._cached("velocity", lambda: _sales_velocity(self.sales[:50]))
+
+    def profitability_analysis(self) -> Dict[str, Any]:
+        return self._cached("profitability", lambda: _profitability_analysis(self.sales))
+
+    def expense_breakdown(self) -> Dict[str, float]:
+        return self._cached("expense_breakdown", lambda: dict(
+            sorted(self.expense_categories.items(), key=lambda x: x[1], reverse=True)))
+
+    def roi_analysis(self) -> Dict[str, Any]:
+        return self._cached("roi", lambda: _roi_analysis(self.sales, self.expenses, self.ad_expenses))
+
+    def sales_forecast(self, days: int = 30) -> Dict[str, Any]:
+        return self._cached(("forecast", days),
+                            lambda: _sales_forecast(self.daily_statistics(min(30, days * 2)), days))
+
+    def summary(self) -> Dict[str, Any]:
+        details = self.details()
+        if not details:
+            return {}
+
+        return {
+            "details": details,
+            "velocity": self.sales_velocity(),
+            "profitability": self.profitability_analysis(),
+            "roi": self.roi_analysis(),
+            "forecast": self.sales_forecast(30),
+            "daily_stats": self.daily_statistics(7, include_transactions=True),
+            "expense_breakdown": self.expense_breakdown(),
+            "generated_at": datetime.now().isoformat()
+        }
+
+
+class LRUCache:
+    """Кэш ограниченного размера с вытеснением давно не использованных записей.
+
+    Запись хранится вместе с версией; get() с другой версией считается промахом,
+    а put() заменяет устаревшую запись.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Any, version: Any) -> Any:
+        item = self._items.get(key)
+        if item is None or item[0] != version:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key: Any, version: Any, value: Any) -> None:
+        self._items[key] = (version, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._items),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+# Аналитика сессий по ключу session_id с версией (last_updated, сегодняшняя дата):
+# любое изменение сессии обновляет last_updated, а дата сдвигает дневные окна
+_analytics_cache = LRUCache(ANALYTICS_CACHE_SIZE)
+
+
+def _drop_caches() -> None:
+    """Сбрасывает кэши в памяти, когда данные изменил другой экземпляр бота"""
+    _access_cache.invalidate()
+    _analytics_cache.clear()
+
+
+db_manager.add_change_listener(_drop_caches)
+
+
+def get_analytics_cache_stats() -> Dict[str, int]:
+    """Возвращает размер и счетчики попаданий кэша аналитики"""
+    return _analytics_cache.stats()
+
+
+async def load_session_analytics(session_id: int) -> SessionAnalytics:
+    """Возвращает аналитику сессии из кэша или загружает сессию и все её транзакции одним запросом"""
+    session_data = await _load_session(session_id)
+    version = (session_data.get("last_updated") if session_data else None, datetime.now().date().isoformat())
 
-            trans_date = datetime.fromisoformat(trans_data["created_at"])
+    analytics = _analytics_cache.get(session_id, version)
+    if analytics is not None:
+        return analytics
 
-            if date_start <= trans_date <= date_end:
-                if trans_data.get("type") == "sale":
-                    daily_sales.append(trans_data)
-                elif trans_data.get("type") == "expense":
-                    daily_expenses.append(trans_data)
+    rows = await _storage().find("transactions", {"session_id": session_id},
+                                 order_by="created_at", descending=True)
+    analytics = SessionAnalytics(session_id, session_data, rows)
+    if session_data:
+        _analytics_cache.put(session_id, version, analytics)
+    return analytics
 
-        total_daily_sales = sum(s.get("amount", 0) for s in daily_sales)
-        total_daily_expenses = sum(s.get("expense_amount", 0) for s in daily_sales) + \
-                               sum(e.get("amount", 0) for e in daily_expenses)
 
-        daily_stats.append({
+def _daily_statistics(daily: Dict[str, Dict[str, float]], days: int,
+                      day_transactions: Dict[str, List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """Статистика за последние N дней по дневным счетчикам сессии.
+    Если передан day_transactions (дата -> транзакции), в каждый день добавляются его транзакции."""
+    today = datetime.now().date()
+    daily_stats = []
+
+    for i in range(days):
+        date = today - timedelta(days=i)
+        bucket = daily.get(date.isoformat(), {})
+
+        total_daily_sales = bucket.get("total_sales", 0)
+        total_daily_expenses = bucket.get("total_expenses", 0)
+
+        day_stats = {
             "date": date.isoformat(),
             "date_display": date.strftime("%d.%m.%Y"),
             "day_name": date.strftime("%A"),
-            "sales_count": len(daily_sales),
-            "expenses_count": len(daily_expenses),
+            "sales_count": bucket.get("sales_count", 0),
+            "expenses_count": bucket.get("expenses_count", 0),
             "total_sales": total_daily_sales,
             "total_expenses": total_daily_expenses,
-            "net_profit": total_daily_sales - total_daily_expenses,
-            "transactions": daily_sales + daily_expenses
-        })
+            "net_profit": total_daily_sales - total_daily_expenses
+        }
+        if day_transactions is not None:
+            day_stats["transactions"] = day_transactions.get(date.isoformat(), [])
+
+        daily_stats.append(day_stats)
 
     return daily_stats
 
 
-def get_sales_velocity(session_id: int) -> Dict[str, Any]:
-    """Анализирует скорость продаж (сколько времени между продажами)"""
-    transactions = get_transactions_list(session_id, 'sale', limit=50)
+async def get_daily_statistics(session_id: int, days: int = 7,
+                               include_transactions: bool = False) -> List[Dict[str, Any]]:
+    """Возвращает статистику по дням за последние N дней.
+
+    Счетчики берутся из дневной статистики сессии, так что окно любой длины — это
+    выборка N дней. С include_transactions=True в каждый день добавляются его транзакции.
+    """
+    if include_transactions:
+        return (await load_session_analytics(session_id)).daily_statistics(days, include_transactions=True)
+
+    session_data = await _load_session(session_id)
+    return _daily_statistics(session_data["daily"] if session_data else {}, days)
+
+
+def _sales_velocity(transactions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Скорость продаж по списку последних продаж"""
 
     if len(transactions) < 2:
         return {
@@ -678,9 +1245,13 @@ def get_sales_velocity(session_id: int) -> Dict[str, Any]:
     }
 
 
-def get_profitability_analysis(session_id: int) -> Dict[str, Any]:
-    """Анализ прибыльности продаж"""
-    sales = get_transactions_list(session_id, 'sale')
+async def get_sales_velocity(session_id: int) -> Dict[str, Any]:
+    """Анализирует скорость продаж (сколько времени между продажами)"""
+    return (await load_session_analytics(session_id)).sales_velocity()
+
+
+def _profitability_analysis(sales: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Прибыльность по списку продаж"""
 
     if not sales:
         return {
@@ -731,6 +1302,11 @@ def get_profitability_analysis(session_id: int) -> Dict[str, Any]:
     }
 
 
+async def get_profitability_analysis(session_id: int) -> Dict[str, Any]:
+    """Анализ прибыльности продаж"""
+    return (await load_session_analytics(session_id)).profitability_analysis()
+
+
 def get_quick_expense_categories() -> List[str]:
     """Возвращает список категорий для быстрых затрат (интернет-продажи)"""
     return [
@@ -747,71 +1323,58 @@ def get_quick_expense_categories() -> List[str]:
     ]
 
 
-def add_quick_expense(session_id: int, category: str, amount: float, description: str = "") -> int:
+async def add_quick_expense(session_id: int, category: str, amount: float, description: str = "") -> int:
     """Добавляет быструю затрату по категории"""
     if not description:
         description = f"Быстрая затрата: {category}"
 
-    return add_transaction(session_id, 'expense', amount, 0, description)
-
-
-def get_expense_breakdown(session_id: int) -> Dict[str, float]:
+    return await add_transaction(session_id, 'expense', amount, 0, description)
+
+
+def _expense_category(desc: str) -> str:
+    """Определяет категорию затраты по описанию"""
+    category = "Прочее"
+
+    # Проверяем ключевые слова
+    desc_lower = desc.lower()
+    if any(word in desc_lower for word in ["таргет", "таргетирован", "социальн"]):
+        category = "Реклама (таргет)"
+    elif any(word in desc_lower for word in ["контекст", "яндекс", "google", "поиск"]):
+        category = "Реклама (контекст)"
+    elif any(word in desc_lower for word in ["креатив", "дизайн", "фото", "видео"]):
+        category = "Креативы"
+    elif any(word in desc_lower for word in ["доставк", "курьер", "почта", "тк"]):
+        category = "Доставка"
+    elif any(word in desc_lower for word in ["упаковк", "коробк", "пленк"]):
+        category = "Упаковка"
+    elif any(word in desc_lower for word in ["возврат", "отмен"]):
+        category = "Возвраты"
+    elif any(word in desc_lower for word in ["сайт", "хостинг", "домен"]):
+        category = "Обслуживание сайта"
+    elif any(word in desc_lower for word in ["подписк", "сервис", "приложен"]):
+        category = "Подписки (сервисы)"
+    elif "быстрая затрата:" in desc_lower:
+        # Извлекаем категорию из быстрой затраты
+        parts = desc.split(":")
+        if len(parts) > 1:
+            category = parts[1].strip()
+
+    return category
+
+
+def _is_ad_expense(desc: str) -> bool:
+    """Затрата на рекламу по описанию"""
+    desc = desc.lower()
+    return any(word in desc for word in ["реклам", "таргет", "контекст", "продвижен"])
+
+
+async def get_expense_breakdown(session_id: int) -> Dict[str, float]:
     """Разбивает затраты по категориям"""
-    expenses = get_transactions_list(session_id, 'expense')
-
-    categories = {}
-
-    for expense in expenses:
-        desc = expense.get("description", "")
-        amount = expense.get("amount", 0)
-
-        # Определяем категорию из описания
-        category = "Прочее"
-
-        # Проверяем ключевые слова
-        desc_lower = desc.lower()
-        if any(word in desc_lower for word in ["таргет", "таргетирован", "социальн"]):
-            category = "Реклама (таргет)"
-        elif any(word in desc_lower for word in ["контекст", "яндекс", "google", "поиск"]):
-            category = "Реклама (контекст)"
-        elif any(word in desc_lower for word in ["креатив", "дизайн", "фото", "видео"]):
-            category = "Креативы"
-        elif any(word in desc_lower for word in ["доставк", "курьер", "почта", "тк"]):
-            category = "Доставка"
-        elif any(word in desc_lower for word in ["упаковк", "коробк", "пленк"]):
-            category = "Упаковка"
-        elif any(word in desc_lower for word in ["возврат", "отмен"]):
-            category = "Возвраты"
-        elif any(word in desc_lower for word in ["сайт", "хостинг", "домен"]):
-            category = "Обслуживание сайта"
-        elif any(word in desc_lower for word in ["подписк", "сервис", "приложен"]):
-            category = "Подписки (сервисы)"
-        elif "быстрая затрата:" in desc_lower:
-            # Извлекаем категорию из быстрой затраты
-            parts = desc.split(":")
-            if len(parts) > 1:
-                category = parts[1].strip()
-
-        if category in categories:
-            categories[category] += amount
-        else:
-            categories[category] = amount
-
-    return dict(sorted(categories.items(), key=lambda x: x[1], reverse=True))
-
-
-def get_roi_analysis(session_id: int) -> Dict[str, Any]:
-    """Анализ ROI (Return on Investment)"""
-    sales = get_transactions_list(session_id, 'sale')
-    expenses = get_transactions_list(session_id, 'expense')
+    return (await load_session_analytics(session_id)).expense_breakdown()
 
-    # Общие затраты на рекламу
-    ad_expenses = 0
-    for expense in expenses:
-        desc = expense.get("description", "").lower()
-        if any(word in desc for word in ["реклам", "таргет", "контекст", "продвижен"]):
-            ad_expenses += expense.get("amount", 0)
 
+def _roi_analysis(sales: List[Dict[str, Any]], expenses: List[Dict[str, Any]], ad_expenses: float) -> Dict[str, Any]:
+    """ROI по спискам продаж и затрат и сумме затрат на рекламу"""
     total_revenue = sum(sale.get("amount", 0) for sale in sales)
     total_expenses = sum(expense.get("amount", 0) for expense in expenses)
 
@@ -855,9 +1418,13 @@ def get_roi_analysis(session_id: int) -> Dict[str, Any]:
     }
 
 
-def get_sales_forecast(session_id: int, days: int = 30) -> Dict[str, Any]:
-    """Прогноз продаж на основе исторических данных"""
-    daily_stats = get_daily_statistics(session_id, min(30, days * 2))
+async def get_roi_analysis(session_id: int) -> Dict[str, Any]:
+    """Анализ ROI (Return on Investment)"""
+    return (await load_session_analytics(session_id)).roi_analysis()
+
+
+def _sales_forecast(daily_stats: List[Dict[str, Any]], days: int) -> Dict[str, Any]:
+    """Прогноз продаж на N дней по дневной статистике"""
 
     if len(daily_stats) < 7:
         return {
@@ -916,52 +1483,27 @@ def get_sales_forecast(session_id: int, days: int = 30) -> Dict[str, Any]:
     }
 
 
-# --- ФУНКЦИИ ДЛЯ ЭКСПОРТА И ОТЧЕТОВ ---
+async def get_sales_forecast(session_id: int, days: int = 30) -> Dict[str, Any]:
+    """Прогноз продаж на основе исторических данных"""
+    return (await load_session_analytics(session_id)).sales_forecast(days)
 
-def get_session_summary(session_id: int) -> Dict[str, Any]:
-    """Возвращает полную сводку по сессии"""
-    details = get_session_details(session_id)
-    if not details:
-        return {}
 
-    velocity = get_sales_velocity(session_id)
-    profitability = get_profitability_analysis(session_id)
-    roi = get_roi_analysis(session_id)
-    forecast = get_sales_forecast(session_id, 30)
-    daily_stats = get_daily_statistics(session_id, 7)
-    expense_breakdown = get_expense_breakdown(session_id)
+# --- ФУНКЦИИ ДЛЯ ЭКСПОРТА И ОТЧЕТОВ ---
 
-    return {
-        "details": details,
-        "velocity": velocity,
-        "profitability": profitability,
-        "roi": roi,
-        "forecast": forecast,
-        "daily_stats": daily_stats,
-        "expense_breakdown": expense_breakdown,
-        "generated_at": datetime.now().isoformat()
-    }
+async def get_session_summary(session_id: int) -> Dict[str, Any]:
+    """Возвращает полную сводку по сессии"""
+    return (await load_session_analytics(session_id)).summary()
 
 
 # --- ИНИЦИАЛИЗАЦИЯ ---
 
-def init_db() -> None:
-    """Инициализирует базу данных в JSONBin"""
-    data = db_manager._load_data()
-
+async def init_db() -> None:
+    """Инициализирует базу данных в выбранном хранилище"""
     # Проверяем структуру данных
-    for key in INITIAL_DATA_STRUCTURE.keys():
-        if key not in data:
-            data[key] = INITIAL_DATA_STRUCTURE[key]
+    await _storage().init_schema()
 
     # Добавляем главного администратора, если его нет
-    if "8382571809" not in data["users"]:
-        data["users"]["8382571809"] = {
-            "role": "admin",
-            "access_expiry": None,
-            "created_at": datetime.now().isoformat(),
-            "last_active": datetime.now().isoformat()
-        }
+    if await _storage().get("users", 8382571809) is None:
+        await _storage().put("users", 8382571809, _new_user("admin"))
 
-    db_manager._save_data(data)
-    print("База данных инициализирована в JSONBin")
\ No newline at end of file
+    print(f"База данных инициализирована ({STORAGE_BACKEND})")
\ No newline at end of file
@@ -6,25 +6,25 @@ from typing import List, Dict, Any
 from db import get_transactions_list, get_debts_list, get_session_details, get_session_summary
 
 
-def generate_text_report(session_id: int) -> str:
+async def generate_text_report(session_id: int) -> str:
     """Генерирует текстовый отчет по сессии"""
     from analytics import generate_analytics_report
 
-    summary = get_session_summary(session_id)
+    summary = await get_session_summary(session_id)
     if not summary:
         return "Ошибка: не удалось получить данные сессии"
 
     return generate_analytics_report(summary)
 
 
-def generate_excel_report(session_id: int) -> io.BytesIO:
+async def generate_excel_report(session_id: int) -> io.BytesIO:
     """Генерирует Excel отчет по сессии"""
     # Получаем данные
-    sales = get_transactions_list(session_id, 'sale')
-    expenses = get_transactions_list(session_id, 'expense')
-    debts_owed = get_debts_list(session_id, 'owed_to_me')
-    debts_i_owe = get_debts_list(session_id, 'i_owe')
-    session_details = get_session_details(session_id)
+    sales = await get_transactions_list(session_id, 'sale')
+    expenses = await get_transactions_list(session_id, 'expense')
+    debts_owed = await get_debts_list(session_id, 'owed_to_me')
+    debts_i_owe = await get_debts_list(session_id, 'i_owe')
+    session_details = await get_session_details(session_id)
 
     if not session_details:
         return None
@@ -128,7 +128,7 @@ def generate_excel_report(session_id: int) -> io.BytesIO:
         df_summary.to_excel(writer, sheet_name='Итоги', index=False)
 
         # Лист с аналитикой
-        summary = get_session_summary(session_id)
+        summary = await get_session_summary(session_id)
         if summary:
             analytics_data = {
                 'Метрика': [
@@ -161,17 +161,17 @@ def generate_excel_report(session_id: int) -> io.BytesIO:
     return output
 
 
-def generate_csv_report(session_id: int, data_type: str = 'sales') -> io.BytesIO:
+async def generate_csv_report(session_id: int, data_type: str = 'sales') -> io.BytesIO:
     """Генерирует CSV отчет"""
     if data_type == 'sales':
-        data = get_transactions_list(session_id, 'sale')
+        data = await get_transactions_list(session_id, 'sale')
         filename = 'sales'
     elif data_type == 'expenses':
-        data = get_transactions_list(session_id, 'expense')
+        data = await get_transactions_list(session_id, 'expense')
         filename = 'expenses'
     elif data_type == 'debts':
-        data_owed = get_debts_list(session_id, 'owed_to_me')
-        data_i_owe = get_debts_list(session_id, 'i_owe')
+        data_owed = await get_debts_list(session_id, 'owed_to_me')
+        data_i_owe = await get_debts_list(session_id, 'i_owe')
         data = data_owed + data_i_owe
         filename = 'debts'
     else:
@@ -16,6 +16,7 @@ from keyboards import *
 from states import *
 from analytics import *
 from export import *
+from broadcast import enqueue_broadcast, describe_broadcast
 
 # --- НАСТРОЙКИ ---
 ADMIN_ID = 8382571809
@@ -50,8 +51,8 @@ async def show_main_menu(event: types.Message | types.CallbackQuery, state: FSMC
     """Показывает главное меню"""
     await state.clear()
     user_id = event.from_user.id
-    is_admin = get_user_role(user_id) == 'admin'
-    sessions = get_user_sessions(user_id)
+    is_admin = await get_user_role(user_id) == 'admin'
+    sessions = await get_user_sessions(user_id)
 
     if not sessions:
         welcome_text = text or "Добро пожаловать! 🎉\n\nУ вас пока нет сессий. Создайте новую!"
@@ -73,11 +74,11 @@ async def show_main_menu(event: types.Message | types.CallbackQuery, state: FSMC
 async def show_session_menu(event: types.Message | types.CallbackQuery, state: FSMContext, session_id: int):
     """Показывает меню сессии"""
     await state.update_data(current_session_id=session_id)
-    details = get_session_details(session_id)
+    details = await get_session_details(session_id)
 
     if not details:
         text = "Ошибка: сессия не найдена."
-        reply_markup = get_main_menu_inline([], get_user_role(event.from_user.id) == 'admin')
+        reply_markup = get_main_menu_inline([], await get_user_role(event.from_user.id) == 'admin')
 
         if isinstance(event, CallbackQuery):
             try:
@@ -117,7 +118,7 @@ class AccessMiddleware:
 
     async def __call__(self, handler, event: types.Message | types.CallbackQuery, data: dict) -> any:
         user_id = event.from_user.id
-        update_user_activity(user_id)
+        await update_user_activity(user_id)
 
         if isinstance(event, types.Message) and event.text == '/start':
             return await handler(event, data)
@@ -126,12 +127,12 @@ class AccessMiddleware:
             return await handler(event, data)
 
         if isinstance(event, types.CallbackQuery) and event.data.startswith('admin_'):
-            is_admin = get_user_role(user_id) == 'admin'
+            is_admin = await get_user_role(user_id) == 'admin'
             if not is_admin:
                 await event.answer("Доступ запрещен.", show_alert=True)
                 return
 
-        if not check_user_access(user_id):
+        if not await check_user_access(user_id):
             no_access_text = (
                 f"👋 Привет! Это бот-бухгалтер.\n\n"
                 f"Ваш Telegram ID: <code>{user_id}</code>\n\n"
@@ -166,7 +167,7 @@ class FSMTimeoutMiddleware:
             if last_activity_ts and (datetime.now().timestamp() - last_activity_ts > self.TIMEOUT_SECONDS):
                 await state.clear()
                 text = "Сессия ввода данных истекла. Начните заново."
-                reply_markup = get_main_menu_inline([], get_user_role(event.from_user.id) == 'admin')
+                reply_markup = get_main_menu_inline([], await get_user_role(event.from_user.id) == 'admin')
 
                 if isinstance(event, types.Message):
                     await event.answer(text, reply_markup=reply_markup)
@@ -189,11 +190,11 @@ class FSMTimeoutMiddleware:
 
 async def handle_start_command(message: Message, state: FSMContext):
     """Обработчик команды /start"""
-    ensure_user_exists(message.from_user.id)
+    await ensure_user_exists(message.from_user.id)
 
-    is_admin = get_user_role(message.from_user.id) == 'admin'
+    is_admin = await get_user_role(message.from_user.id) == 'admin'
 
-    if not is_admin and not check_user_access(message.from_user.id):
+    if not is_admin and not await check_user_access(message.from_user.id):
         no_access_text = (
             f"👋 Привет! Это бот-бухгалтер.\n\n"
             f"Ваш Telegram ID: <code>{message.from_user.id}</code>\n\n"
@@ -217,13 +218,14 @@ async def navigate(callback: CallbackQuery, state: FSMContext):
     if action == "start":
         await show_main_menu(callback, state)
     elif action == "admin_panel":
+        broadcast_jobs = await get_broadcast_jobs()
         try:
             await callback.message.edit_text("Выберите действие в Админ-Панели:",
-                                             reply_markup=get_admin_panel_inline())
+                                             reply_markup=get_admin_panel_inline(broadcast_jobs))
         except Exception as e:
             logger.error(f"Ошибка при редактировании сообщения: {e}")
             await callback.bot.send_message(callback.from_user.id, "Выберите действие в Админ-Панели:",
-                                            reply_markup=get_admin_panel_inline())
+                                            reply_markup=get_admin_panel_inline(broadcast_jobs))
     elif action == "create_session":
         try:
             await callback.message.edit_text("Введите название для новой сессии (макс. 50 символов):",
@@ -257,7 +259,7 @@ async def process_session_name(message: Message, state: FSMContext):
         return await message.answer("Название должно быть от 3 до 50 символов. Попробуйте еще раз:",
                                     reply_markup=get_cancel_inline())
 
-    user_sessions = get_user_sessions(message.from_user.id)
+    user_sessions = await get_user_sessions(message.from_user.id)
     existing_names = [session[1] for session in user_sessions]
 
     if session_name in existing_names:
@@ -296,7 +298,7 @@ async def process_budget(message: Message, state: FSMContext):
         return await message.answer("Введите корректное положительное число.", reply_markup=get_cancel_inline())
 
     data = await state.get_data()
-    session_id = add_session(message.from_user.id, data['name'], budget, data['currency'])
+    session_id = await add_session(message.from_user.id, data['name'], budget, data['currency'])
 
     await show_main_menu(message, state, f"✅ Сессия <b>'{data['name']}'</b> создана!")
 
@@ -441,17 +443,21 @@ async def process_sale_description(message: Message, state: FSMContext):
         await message.answer("Ошибка: сессия не найдена.", reply_markup=get_cancel_inline())
         return
 
-    details = get_session_details(session_id)
+    description = message.text.strip()[:100]
+    if not description:
+        description = "Продажа"
+
+    # Проверка сессии и запись продажи: одна загрузка и одно сохранение
+    async with unit_of_work():
+        details = await get_session_details(session_id)
+        if details['is_active']:
+            await add_transaction(session_id, 'sale', data['amount'], data['expense'], description)
+
     if not details['is_active']:
         await message.answer("Сессия закрыта. Добавление невозможно.",
                              reply_markup=get_session_menu_inline(False))
         return
 
-    description = message.text.strip()[:100]
-    if not description:
-        description = "Продажа"
-
-    add_transaction(session_id, 'sale', data['amount'], data['expense'], description)
     await show_session_menu(message, state, session_id)
 
 
@@ -478,17 +484,21 @@ async def process_expense_description(message: Message, state: FSMContext):
         await message.answer("Ошибка: сессия не найдена.", reply_markup=get_cancel_inline())
         return
 
-    details = get_session_details(session_id)
+    description = message.text.strip()[:100]
+    if not description:
+        description = "Затраты"
+
+    # Проверка сессии и запись затраты: одна загрузка и одно сохранение
+    async with unit_of_work():
+        details = await get_session_details(session_id)
+        if details['is_active']:
+            await add_transaction(session_id, 'expense', data['amount'], 0, description)
+
     if not details['is_active']:
         await message.answer("Сессия закрыта. Добавление невозможно.",
                              reply_markup=get_session_menu_inline(False))
         return
 
-    description = message.text.strip()[:100]
-    if not description:
-        description = "Затраты"
-
-    add_transaction(session_id, 'expense', data['amount'], 0, description)
     await show_session_menu(message, state, session_id)
 
 
@@ -527,15 +537,19 @@ async def process_debt_description(message: Message, state: FSMContext):
         await message.answer("Ошибка: сессия не найдена.", reply_markup=get_cancel_inline())
         return
 
-    details = get_session_details(session_id)
+    description = "" if message.text == "/skip" else message.text.strip()[:100]
+
+    # Проверка сессии и запись долга: одна загрузка и одно сохранение
+    async with unit_of_work():
+        details = await get_session_details(session_id)
+        if details['is_active']:
+            await add_debt(session_id, data['debt_type'], data['person_name'], data['amount'], description)
+
     if not details['is_active']:
         await message.answer("Сессия закрыта. Добавление невозможно.",
                              reply_markup=get_session_menu_inline(False))
         return
 
-    description = "" if message.text == "/skip" else message.text.strip()[:100]
-
-    add_debt(session_id, data['debt_type'], data['person_name'], data['amount'], description)
     await show_session_menu(message, state, session_id)
 
 
@@ -562,7 +576,7 @@ async def show_transactions_list(event: types.Message | types.CallbackQuery, sta
             await event.answer(text, reply_markup=reply_markup)
         return
 
-    items = get_transactions_list(session_id, t_type, search_query, limit=20)
+    items = await get_transactions_list(session_id, t_type, search_query, limit=20)
 
     if not items:
         type_name = "Продаж" if t_type == 'sale' else "Затрат"
@@ -631,7 +645,7 @@ async def show_debts_list(event: types.Message | types.CallbackQuery, state: FSM
             await event.answer(text, reply_markup=reply_markup)
         return
 
-    items = get_debts_list(session_id, debt_type, search_query, limit=20)
+    items = await get_debts_list(session_id, debt_type, search_query, limit=20)
 
     if not items:
         type_name = "Долгов вам" if debt_type == 'owed_to_me' else "Ваших долгов"
@@ -810,9 +824,9 @@ async def process_edit_field(message: Message, state: FSMContext):
 
     success = False
     if item_type == 'transaction':
-        success = update_transaction(item_id, field, new_value)
+        success = await update_transaction(item_id, field, new_value)
     elif item_type == 'debt':
-        success = update_debt(item_id, field, new_value)
+        success = await update_debt(item_id, field, new_value)
 
     if success:
         await message.answer("✅ Изменения сохранены.")
@@ -834,7 +848,7 @@ async def handle_repay_debt(callback: CallbackQuery, state: FSMContext):
         await callback.answer("Неверный ID долга.", show_alert=True)
         return
 
-    success = update_debt(debt_id, 'is_repaid', 1)
+    success = await update_debt(debt_id, 'is_repaid', 1)
 
     if success:
         await callback.answer("✅ Долг отмечен как погашенный.", show_alert=True)
@@ -896,22 +910,22 @@ async def process_confirmation(callback: CallbackQuery, state: FSMContext):
     success = False
 
     if action_type == 'del_transaction':
-        success = delete_transaction(item_id)
+        success = await delete_transaction(item_id)
         if success:
             await callback.answer("✅ Транзакция удалена.", show_alert=True)
         else:
             await callback.answer("❌ Ошибка при удалении транзакции.", show_alert=True)
 
     elif action_type == 'del_debt':
-        success = delete_debt(item_id)
+        success = await delete_debt(item_id)
         if success:
             await callback.answer("✅ Долг удален.", show_alert=True)
         else:
             await callback.answer("❌ Ошибка при удалении долга.", show_alert=True)
 
     elif action_type == 'close_session':
-        close_session(item_id)
-        details = get_session_details(item_id)
+        await close_session(item_id)
+        details = await get_session_details(item_id)
 
         if details:
             reply_markup = InlineKeyboardMarkup(
@@ -968,7 +982,7 @@ async def show_report(callback: CallbackQuery, state: FSMContext):
         await callback.answer("Ошибка: сессия не найдена.", show_alert=True)
         return
 
-    details = get_session_details(session_id)
+    details = await get_session_details(session_id)
 
     if not details:
         await callback.answer("Ошибка получения данных.", show_alert=True)
@@ -1072,7 +1086,7 @@ async def advanced_features_handler(callback: CallbackQuery, state: FSMContext):
 async def show_detailed_analytics(callback: CallbackQuery, state: FSMContext, session_id: int):
     """Показывает детальную аналитику"""
     try:
-        summary = get_session_summary(session_id)
+        summary = await get_session_summary(session_id)
         if not summary:
             await callback.answer("Ошибка: сессия не найдена.", show_alert=True)
             return
@@ -1096,7 +1110,7 @@ async def show_detailed_analytics(callback: CallbackQuery, state: FSMContext, se
     await callback.answer()
 async def show_sales_velocity(callback: CallbackQuery, state: FSMContext, session_id: int):
     """Показывает анализ скорости продаж"""
-    velocity = get_sales_velocity(session_id)
+    velocity = await get_sales_velocity(session_id)
 
     text = f"🚀 <b>АНАЛИЗ СКОРОСТИ ПРОДАЖ</b>\n\n"
     text += f"• Среднее время между продажами: <b>{velocity['avg_time_between_sales']:.1f} часов</b>\n"
@@ -1129,7 +1143,7 @@ async def show_sales_velocity(callback: CallbackQuery, state: FSMContext, sessio
 
 async def show_roi_analysis(callback: CallbackQuery, state: FSMContext, session_id: int):
     """Показывает анализ ROI"""
-    roi = get_roi_analysis(session_id)
+    roi = await get_roi_analysis(session_id)
 
     text = f"🎯 <b>АНАЛИЗ ROI (ОКУПАЕМОСТИ)</b>\n\n"
     text += f"• Общий ROI: <b>{roi['roi_percentage']:.1f}%</b>\n"
@@ -1174,10 +1188,10 @@ async def handle_chart_selection(callback: CallbackQuery, state: FSMContext, bot
         await callback.answer("Ошибка: сессия не найдена.", show_alert=True)
         return
 
-    details = get_session_details(session_id)
+    details = await get_session_details(session_id)
 
     if chart_type == "profit":
-        daily_stats = get_daily_statistics(session_id, 14)
+        daily_stats = await get_daily_statistics(session_id, 14)
         chart_bytes = generate_profit_chart(daily_stats, details['currency'])
 
         if chart_bytes:
@@ -1191,7 +1205,7 @@ async def handle_chart_selection(callback: CallbackQuery, state: FSMContext, bot
             await callback.answer("Недостаточно данных для графика.", show_alert=True)
 
     elif chart_type == "expenses":
-        expense_breakdown = get_expense_breakdown(session_id)
+        expense_breakdown = await get_expense_breakdown(session_id)
         chart_bytes = generate_expense_pie_chart(expense_breakdown, details['currency'])
 
         if chart_bytes:
@@ -1205,7 +1219,7 @@ async def handle_chart_selection(callback: CallbackQuery, state: FSMContext, bot
             await callback.answer("Нет данных о затратах.", show_alert=True)
 
     elif chart_type == "velocity":
-        daily_stats = get_daily_statistics(session_id, 14)
+        daily_stats = await get_daily_statistics(session_id, 14)
         chart_bytes = generate_sales_velocity_chart(daily_stats, details['currency'])
 
         if chart_bytes:
@@ -1219,7 +1233,7 @@ async def handle_chart_selection(callback: CallbackQuery, state: FSMContext, bot
             await callback.answer("Недостаточно данных для графика.", show_alert=True)
 
     elif chart_type == "combined":
-        daily_stats = get_daily_statistics(session_id, 14)
+        daily_stats = await get_daily_statistics(session_id, 14)
         chart_bytes = generate_combined_chart(daily_stats, details['currency'])
 
         if chart_bytes:
@@ -1276,7 +1290,7 @@ async def process_quick_expense_amount(message: Message, state: FSMContext):
     session_id = data.get('current_session_id')
     category = data.get('quick_category', 'Прочее')
 
-    add_quick_expense(session_id, category, amount)
+    await add_quick_expense(session_id, category, amount)
 
     await message.answer(f"✅ Быстрая затрата добавлена:\n{category}: {amount:.2f}")
     await show_session_menu(message, state, session_id)
@@ -1284,8 +1298,8 @@ async def process_quick_expense_amount(message: Message, state: FSMContext):
 
 async def show_expense_categories(callback: CallbackQuery, state: FSMContext, session_id: int):
     """Показывает категории затрат"""
-    expense_breakdown = get_expense_breakdown(session_id)
-    details = get_session_details(session_id)
+    expense_breakdown = await get_expense_breakdown(session_id)
+    details = await get_session_details(session_id)
 
     if not expense_breakdown:
         text = "Затрат пока нет. Добавьте первую затрату!"
@@ -1348,8 +1362,8 @@ async def process_custom_forecast_days(message: Message, state: FSMContext):
 async def show_sales_forecast(event: types.Message | types.CallbackQuery, state: FSMContext, session_id: int,
                               days: int):
     """Показывает прогноз продаж"""
-    forecast = get_sales_forecast(session_id, days)
-    details = get_session_details(session_id)
+    forecast = await get_sales_forecast(session_id, days)
+    details = await get_session_details(session_id)
 
     text = f"🔮 <b>ПРОГНОЗ ПРОДАЖ НА {days} ДНЕЙ</b>\n\n"
     text += f"• Ожидаемая прибыль: <b>{forecast['forecast_profit']:.0f} {details['currency']}</b>\n"
@@ -1426,7 +1440,7 @@ async def process_change_name(message: Message, state: FSMContext):
         return await message.answer("Название должно быть не менее 3 символов.", reply_markup=get_cancel_inline())
 
     session_id = (await state.get_data()).get('current_session_id')
-    if session_id and update_session(session_id, 'name', new_name):
+    if session_id and await update_session(session_id, 'name', new_name):
         await message.answer(f"✅ Название сессии изменено на: {new_name}")
         await show_session_menu(message, state, session_id)
     else:
@@ -1443,7 +1457,7 @@ async def process_change_budget(message: Message, state: FSMContext):
         return await message.answer("Введите корректное положительное число.", reply_markup=get_cancel_inline())
 
     session_id = (await state.get_data()).get('current_session_id')
-    if session_id and update_session(session_id, 'budget', new_budget):
+    if session_id and await update_session(session_id, 'budget', new_budget):
         await message.answer(f"✅ Бюджет сессии изменен на: {new_budget:.2f}")
         await show_session_menu(message, state, session_id)
     else:
@@ -1452,7 +1466,7 @@ async def process_change_budget(message: Message, state: FSMContext):
 
 async def show_settings_summary(callback: CallbackQuery, state: FSMContext, session_id: int):
     """Показывает сводку настроек сессии"""
-    details = get_session_details(session_id)
+    details = await get_session_details(session_id)
     if not details:
         await callback.answer("Ошибка: сессия не найдена.", show_alert=True)
         return
@@ -1550,7 +1564,7 @@ async def admin_panel_handler(callback: CallbackQuery, state: FSMContext):
         await state.set_state(AdminManageAccess.close_user)
 
     elif action == "open_all":
-        success = grant_access_to_all()
+        success = await grant_access_to_all()
         if success:
             reply_text = "✅ Доступ для всех пользователей открыт на 30 дней."
         else:
@@ -1564,7 +1578,7 @@ async def admin_panel_handler(callback: CallbackQuery, state: FSMContext):
                                             reply_markup=get_access_management_inline())
 
     elif action == "close_all":
-        success = revoke_temporary_access()
+        success = await revoke_temporary_access()
         if success:
             reply_text = "✅ Доступ для неоплативших пользователей закрыт."
         else:
@@ -1601,6 +1615,18 @@ async def admin_panel_handler(callback: CallbackQuery, state: FSMContext):
                 reply_markup=get_cancel_inline())
         await state.set_state(AdminManageAdmins.remove)
 
+    elif action.startswith("bjob_"):
+        job = await get_broadcast_job(int(action.split('_', 1)[1]))
+        if not job:
+            await callback.answer("Рассылка не найдена", show_alert=True)
+            return
+        try:
+            await callback.message.edit_text(describe_broadcast(job), reply_markup=get_broadcast_job_inline(job['id']))
+        except Exception as e:
+            logger.error(f"Ошибка при редактировании сообщения: {e}")
+            await callback.bot.send_message(callback.from_user.id, describe_broadcast(job),
+                                            reply_markup=get_broadcast_job_inline(job['id']))
+
     elif action.startswith("broadcast_"):
         audience = action.split('_', 1)[1]
         await state.update_data(audience=audience)
@@ -1642,7 +1668,7 @@ async def process_open_user_access(message: Message, state: FSMContext):
             await message.answer("Количество дней должно быть положительным числом.")
             return
 
-        update_user_access(user_id, True, days)
+        await update_user_access(user_id, True, days)
         await message.answer(f"✅ Пользователю {user_id} открыт доступ на {days} дней.")
 
     except (ValueError, IndexError):
@@ -1658,7 +1684,7 @@ async def process_close_user_access(message: Message, state: FSMContext):
 
     try:
         user_id = int(message.text)
-        update_user_access(user_id, False)
+        await update_user_access(user_id, False)
         await message.answer(f"✅ Пользователю {user_id} закрыт доступ.")
 
     except ValueError:
@@ -1677,7 +1703,7 @@ async def process_add_admin(message: Message, state: FSMContext):
             await message.answer("❌ Вы не можете добавить самого себя.")
             return
 
-        add_admin(user_id)
+        await add_admin(user_id)
         await message.answer(f"✅ Пользователь {user_id} теперь администратор.")
 
     except ValueError:
@@ -1698,7 +1724,7 @@ async def process_remove_admin(message: Message, state: FSMContext):
         if user_id == message.from_user.id:
             return await message.answer("❌ Вы не можете удалить самого себя.")
 
-        remove_admin(user_id)
+        await remove_admin(user_id)
         await message.answer(f"✅ Пользователь {user_id} больше не администратор.")
 
     except ValueError:
@@ -1718,38 +1744,12 @@ async def process_broadcast(message: Message, state: FSMContext, bot: Bot):
         await state.clear()
         return
 
-    all_users = get_all_users()
-    users_to_send = []
-
-    if audience == "all":
-        users_to_send = [u['user_id'] for u in all_users]
-    elif audience == "access":
-        users_to_send = [u['user_id'] for u in all_users if check_user_access(u['user_id'])]
-    elif audience == "no_access":
-        users_to_send = [u['user_id'] for u in all_users if not check_user_access(u['user_id'])]
-
-    success_count = 0
-    failed_count = 0
+    users_to_send = await get_broadcast_audience(audience)
 
-    await message.answer(f"📤 Начинаю рассылку для {len(users_to_send)} пользователей...")
-
-    for user_id in users_to_send:
-        try:
-            await bot.send_message(chat_id=user_id, text=message.text)
-            success_count += 1
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            failed_count += 1
-            logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-
-    result_text = (
-        f"✅ Рассылка завершена.\n"
-        f"Успешно отправлено: {success_count}\n"
-        f"Не удалось отправить: {failed_count}\n"
-        f"Всего пользователей: {len(users_to_send)}"
-    )
+    # Рассылка идет в фоне и сама обновляет это сообщение, админ сразу возвращается в меню
+    progress = await message.answer(f"🕓 Рассылка для {len(users_to_send)} пользователей поставлена в очередь...")
+    await enqueue_broadcast(bot, message.from_user.id, progress.message_id, message.text, users_to_send)
 
-    await message.answer(result_text)
     await state.clear()
     await show_main_menu(message, state)
 
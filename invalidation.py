@@ -0,0 +1,49 @@
+# invalidation.py
+import asyncio
+from typing import List, Callable, Awaitable
+
+# Обработчик уведомления: (экземпляр-источник, ключ документа, новая версия)
+Listener = Callable[[str, str, int], Awaitable[None]]
+
+
+class InvalidationChannel:
+    """Канал, через который экземпляры бота сообщают друг другу о сохраненных документах.
+
+    Каждый экземпляр после успешного сохранения публикует ключ документа и его
+    новую версию, а остальные помечают свою копию устаревшей и перечитывают её
+    при следующем обращении. Реализация канала (Redis, Postgres NOTIFY и т.п.)
+    подключается через create_invalidation_channel().
+    """
+
+    async def publish(self, source: str, key: str, version: int) -> None:
+        """Рассылает подписчикам уведомление о новой версии документа key"""
+        raise NotImplementedError
+
+    def subscribe(self, listener: Listener) -> None:
+        """Подписывает listener на уведомления всех экземпляров"""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """Освобождает соединения канала"""
+
+
+class LocalInvalidationChannel(InvalidationChannel):
+    """Канал внутри одного процесса: заменяет внешний брокер, когда экземпляр один
+    или несколько хранилищ работают в одном процессе"""
+
+    def __init__(self):
+        self._listeners: List[Listener] = []
+
+    async def publish(self, source: str, key: str, version: int) -> None:
+        if self._listeners:
+            await asyncio.gather(*(listener(source, key, version) for listener in self._listeners))
+
+    def subscribe(self, listener: Listener) -> None:
+        self._listeners.append(listener)
+
+
+def create_invalidation_channel(kind: str) -> InvalidationChannel:
+    """Создает канал по названию из настроек"""
+    if kind == "local":
+        return LocalInvalidationChannel()
+    raise ValueError(f"Неизвестный канал инвалидации INVALIDATION_CHANNEL={kind}")
@@ -0,0 +1,215 @@
+# journal.py
+import asyncio
+import json
+import os
+import uuid
+from typing import List, Dict, Any, Optional, Tuple, Callable
+
+from storage import Mutation, StorageBackend, UnitOfWork
+
+# Задержки повторной отправки журнала в секундах, пока удаленное хранилище недоступно
+REPLAY_MIN_DELAY = 1
+REPLAY_MAX_DELAY = 60
+# Сколько изменений отправлять в хранилище одной пачкой
+REPLAY_BATCH_SIZE = 500
+
+
+class JournaledStorage(StorageBackend):
+    """Хранилище с локальным журналом записи поверх удаленного.
+
+    apply() дописывает изменения в файл журнала на диске и сразу подтверждает
+    запись; фоновая задача отправляет журнал в удаленное хранилище по порядку,
+    повторяя попытки, пока оно недоступно. Чтения видят еще не отправленные
+    изменения через единицу работы поверх хранилища. После перезапуска
+    неотправленный хвост журнала читается с диска и отправляется заново.
+
+    Строки журнала — JSON: {"journal": ID, "seq": N} в начале файла,
+    {"seq": N, "mutations": [...]} для записи и {"ack": N} для отметки, что записи
+    до N включительно сохранены в хранилище. Когда неотправленных записей не
+    остается, файл начинается заново со строки с ID журнала и последним номером.
+
+    Записи уходят в хранилище через apply_journaled(): оно сохраняет номер записи
+    вместе с ее изменениями и пропускает записи, которые уже сохранило. Поэтому
+    запись, отправленная еще раз после неудачного flush() или после остановки
+    процесса до ack, не прибавляет increment повторно. ID журнала отличает его
+    номера от номеров журналов других экземпляров, пишущих в то же хранилище.
+
+    Хранилище должно работать с отложенной записью: apply_journaled() меняет его
+    копию в памяти, а запись подтверждается только после успешного flush().
+    """
+
+    def __init__(self, backend: StorageBackend, path: str):
+        self.backend = backend
+        self.path = path
+        # Неотправленные изменения, которые видят чтения; в хранилище они уходят из журнала
+        self._overlay = UnitOfWork(backend)
+        self._journal: Optional[str] = None
+        self._seq = 0
+        # Неотправленные записи журнала по порядку: (номер, изменения)
+        self._entries: List[Tuple[int, List[Mutation]]] = []
+        self._replayer: Optional[asyncio.Task] = None
+        self._replay_lock = asyncio.Lock()
+        # Записи в файл идут по очереди: apply() ложатся в журнал и в память в одном порядке,
+        # а обнуление файла не теряет строку, которую в это время дописывает apply()
+        self._write_lock = asyncio.Lock()
+
+    # --- ФАЙЛ ЖУРНАЛА ---
+
+    def _write_text(self, text: str, mode: str = "a") -> None:
+        with open(self.path, mode, encoding="utf-8") as journal:
+            journal.write(text)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    async def _write_line(self, line: Dict[str, Any]) -> None:
+        """Дописывает строку в журнал; файл пишется в потоке, чтобы fsync не останавливал цикл событий"""
+        # Сериализуем сразу: пока строка пишется в потоке, изменения в памяти могут поменяться
+        await asyncio.to_thread(self._write_text, json.dumps(line, ensure_ascii=False) + "\n")
+
+    def _header(self) -> Dict[str, Any]:
+        return {"journal": self._journal, "seq": self._seq}
+
+    def _read_pending(self) -> List[Tuple[int, List[Mutation]]]:
+        """Читает с диска записи, которые еще не подтверждены"""
+        if not os.path.exists(self.path):
+            return []
+
+        entries: Dict[int, List[Mutation]] = {}
+        acked = 0
+        with open(self.path, encoding="utf-8") as journal:
+            for raw in journal:
+                try:
+                    line = json.loads(raw)
+                except json.JSONDecodeError:
+                    # Недописанная последняя строка после аварийной остановки
+                    continue
+                if "ack" in line:
+                    acked = max(acked, line["ack"])
+                elif "journal" in line:
+                    self._journal = line["journal"]
+                else:
+                    entries[line["seq"]] = [Mutation(*item) for item in line["mutations"]]
+                self._seq = max(self._seq, line.get("seq", line.get("ack", 0)))
+
+        return [(seq, mutations) for seq, mutations in sorted(entries.items()) if seq > acked]
+
+    # --- ИНТЕРФЕЙС StorageBackend ---
+
+    async def init_schema(self) -> None:
+        await self.backend.init_schema()
+        for seq, mutations in self._read_pending():
+            await self._overlay.apply(mutations)
+            self._entries.append((seq, mutations))
+        if self._journal is None:
+            self._journal = uuid.uuid4().hex
+            try:
+                await self._write_line(self._header())
+            except OSError as e:
+                print(f"Ошибка записи в журнал: {e}")
+        if self._entries:
+            print(f"В журнале записи {sum(len(mutations) for _, mutations in self._entries)} неотправленных изменений")
+            self._schedule_replay()
+
+    async def get(self, collection: str, record_id: int) -> Optional[Dict[str, Any]]:
+        return await self._overlay.get(collection, record_id)
+
+    async def find(self, collection: str, where: Dict[str, Any] = None, since: str = None,
+                   order_by: str = None, descending: bool = False,
+                   limit: int = None) -> List[Tuple[int, Dict[str, Any]]]:
+        return await self._overlay.find(collection, where, since, order_by, descending, limit)
+
+    async def apply(self, mutations: List[Mutation]) -> bool:
+        if not mutations:
+            return True
+        async with self._write_lock:
+            try:
+                await self._write_line({"seq": self._seq + 1, "mutations": [list(mutation) for mutation in mutations]})
+            except OSError as e:
+                print(f"Ошибка записи в журнал: {e}")
+                return False
+            self._seq += 1
+            self._entries.append((self._seq, mutations))
+            await self._overlay.apply(mutations)
+        self._schedule_replay()
+        return True
+
+    async def next_id(self, collection: str, record: Dict[str, Any] = None) -> int:
+        return await self._overlay.next_id(collection, record)
+
+    def id_stride(self, collection: str) -> int:
+        return self.backend.id_stride(collection)
+
+    def add_change_listener(self, listener: Callable[[], None]) -> None:
+        self.backend.add_change_listener(listener)
+
+    async def flush(self) -> bool:
+        """Отправляет журнал и отложенные изменения хранилища"""
+        return await self.replay() and await self.backend.flush()
+
+    async def close(self) -> None:
+        if self._replayer is not None:
+            self._replayer.cancel()
+            self._replayer = None
+        # Что не удалось отправить, останется в журнале до следующего запуска
+        await self.replay()
+        await self.backend.close()
+
+    # --- ОТПРАВКА ЖУРНАЛА ---
+
+    def _schedule_replay(self) -> None:
+        if self._replayer is None or self._replayer.done():
+            self._replayer = asyncio.create_task(self._replay_loop())
+
+    async def _replay_loop(self) -> None:
+        delay = REPLAY_MIN_DELAY
+        while self._entries:
+            if await self.replay():
+                delay = REPLAY_MIN_DELAY
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, REPLAY_MAX_DELAY)
+
+    async def replay(self) -> bool:
+        """Отправляет неотправленные записи журнала в хранилище; False — хранилище недоступно"""
+        async with self._replay_lock:
+            return await self._replay()
+
+    async def _replay(self) -> bool:
+        while self._entries:
+            # Пачка записей сохраняется одним flush(). Записи применяются по одной: хранилище
+            # запоминает номер каждой и при повторе пачки пропускает уже примененные
+            count = size = 0
+            for seq, mutations in self._entries:
+                if count and size + len(mutations) > REPLAY_BATCH_SIZE:
+                    break
+                try:
+                    applied = await self.backend.apply_journaled(self._journal, seq, mutations)
+                except Exception as e:
+                    print(f"Ошибка отправки журнала: {e}")
+                    applied = False
+                if not applied:
+                    return False
+                count += 1
+                size += len(mutations)
+
+            if not await self.backend.flush():
+                return False
+
+            # Пока шла отправка, в конец журнала могли добавиться новые записи
+            seq = self._entries[count - 1][0]
+            del self._entries[:count]
+            self._overlay.release({(mutation.collection, mutation.record_id)
+                                   for _, mutations in self._entries for mutation in mutations})
+            await self._acknowledge(seq)
+        return True
+
+    async def _acknowledge(self, seq: int) -> None:
+        async with self._write_lock:
+            try:
+                if self._entries:
+                    await self._write_line({"ack": seq})
+                else:
+                    # Все отправлено: журнал начинается заново, сохраняя свой ID и нумерацию
+                    await asyncio.to_thread(self._write_text, json.dumps(self._header()) + "\n", "w")
+            except OSError as e:
+                print(f"Ошибка записи в журнал: {e}")
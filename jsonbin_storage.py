@@ -0,0 +1,1079 @@
+# jsonbin_storage.py
+import asyncio
+import copy
+import json
+import os
+import random
+import time
+import uuid
+from typing import List, Dict, Any, Optional, Tuple, Callable
+import aiohttp
+
+from codec import compact_dumps, decode_document, encode_document, is_compact
+from invalidation import InvalidationChannel
+from storage import COLLECTIONS, IndexSet, Mutation, StorageBackend, apply_increment, matches, order_and_limit
+
+JSONBIN_BASE_URL = "https://api.jsonbin.io/v3/b"
+
+# Ответы JSONBin, после которых запрос стоит повторить
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Задержки повторов в секундах: база экспоненты и потолок
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8
+# Предохранитель: сколько неудачных запросов подряд размыкают его и на сколько секунд
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+# Коллекции, которые при шардировании лежат в бинах пользователей
+SHARDED_COLLECTIONS = ("sessions", "transactions", "debts")
+
+# Коллекции с ID, которые выдает бот (у пользователей ID из Telegram).
+# Последний выданный ID хранится в документе в разделе "sequences".
+SEQUENCED_COLLECTIONS = ("sessions", "transactions", "debts", "broadcasts")
+
+# Структура данных для хранения в JSON. Каждый документ хранит номер версии
+# "version", который растет при каждом сохранении.
+INITIAL_DATA_STRUCTURE = {**{collection: {} for collection in COLLECTIONS}, "sequences": {}, "version": 0}
+
+# Каталог при шардировании: пользователи, рассылки, адреса шардов и границы ID,
+# выданных до перехода на шарды
+DIRECTORY_STRUCTURE = {
+    **{collection: {} for collection in COLLECTIONS if collection not in SHARDED_COLLECTIONS},
+    "shards": {}, "legacy_max": {}, "sequences": {}, "version": 0
+}
+SHARD_STRUCTURE = {**{collection: {} for collection in SHARDED_COLLECTIONS}, "sequences": {}, "version": 0}
+
+# Сколько раз повторять изменения поверх более новой версии документа перед сохранением
+CAS_RETRIES = 3
+# Сколько ID экземпляр резервирует за раз, когда в бин пишут несколько экземпляров
+ID_BLOCK_SIZE = 20
+
+# Журнал изменений документа лежит в отдельном бине, адрес которого хранится в
+# снимке под ключом "log_bin"; "log_seq" — номер последней записи журнала,
+# уже вошедшей в снимок
+LOG_KEYS = ("log_bin", "log_seq")
+
+
+def seed_sequences(data: Dict[str, Any]) -> None:
+    """Однократно заводит счетчики ID по максимальным ключам коллекций документа"""
+    for collection in SEQUENCED_COLLECTIONS:
+        if collection in data and collection not in data.get("sequences", {}):
+            existing_ids = [int(id_) for id_ in data[collection].keys() if id_.isdigit()]
+            data.setdefault("sequences", {})[collection] = max(existing_ids, default=0)
+
+
+def write_atomic(path: str, text: str) -> None:
+    """Записывает файл целиком: при сбое на диске остается либо старая, либо новая версия"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def allocate_id(data: Dict[str, Any], collection: str, floor: int = 0, stride: int = 1, remainder: int = 0) -> int:
+    """Выдает следующий ID из счетчика коллекции: больше floor и с остатком remainder по модулю stride"""
+    sequences = data.setdefault("sequences", {})
+    record_id = max(sequences.get(collection, 0), floor) + 1
+    record_id += (remainder - record_id) % stride
+    sequences[collection] = record_id
+    return record_id
+
+
+def merge_journals(data: Dict[str, Any], journals: Dict[str, int]) -> None:
+    """Переносит в документ номера последних примененных записей локальных журналов
+    (journal.py), не уменьшая их"""
+    if not journals:
+        return
+    target = data.setdefault("journals", {})
+    for journal, seq in journals.items():
+        target[journal] = max(target.get(journal, 0), seq)
+
+
+def apply_mutation(data: Dict[str, Any], mutation: Mutation) -> Optional[Tuple[Optional[Dict[str, Any]],
+                                                                              Optional[Dict[str, Any]]]]:
+    """Применяет изменение к документу и возвращает пару (старая запись, новая запись)
+    или None, если изменять нечего"""
+    table = data.setdefault(mutation.collection, {})
+    key = str(mutation.record_id)
+
+    old = table.get(key)
+    if mutation.action == "put":
+        new = table[key] = dict(mutation.data)
+        # Запись с ID, выданным в обход счетчика (например, из журнала записи после перезапуска),
+        # сдвигает счетчик, чтобы этот ID не выдали повторно
+        sequences = data.setdefault("sequences", {})
+        if mutation.collection in SEQUENCED_COLLECTIONS and mutation.record_id > sequences.get(mutation.collection, 0):
+            sequences[mutation.collection] = mutation.record_id
+    elif old is None:
+        return None
+    elif mutation.action == "update":
+        new = table[key] = {**old, **mutation.data}
+    elif mutation.action == "increment":
+        new = table[key] = apply_increment(old, mutation.data)
+    else:
+        del table[key]
+        new = None
+    return old, new
+
+
+class CircuitBreaker:
+    """Предохранитель: после threshold неудачных запросов подряд JSONBin считается
+    недоступным, и запросы сразу завершаются ошибкой, не дожидаясь таймаутов.
+    Через reset_timeout секунд пропускается один пробный запрос."""
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос"""
+        if self._opened_at is None:
+            return True
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return False
+        # Пробный запрос: до его результата остальные снова ждут reset_timeout
+        self._opened_at = time.monotonic()
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+
+
+class JSONBinClient:
+    """HTTP-клиент JSONBin с общей keep-alive сессией.
+
+    Каждый запрос ограничен таймаутом; сетевые ошибки, 429 и 5xx повторяются
+    с экспоненциальной задержкой и случайным разбросом. Пока JSONBin недоступен,
+    предохранитель отклоняет запросы сразу.
+    """
+
+    def __init__(self, api_key: str, pool_size: int = 10, timeout: float = 10, retries: int = 3):
+        self.headers = {
+            "Content-Type": "application/json",
+            "X-Master-Key": api_key,
+        }
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 5))
+        self.retries = retries
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        # Общая HTTP-сессия, создается в работающем event loop
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую HTTP-сессию, создавая её при первом обращении"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(headers=self.headers, connector=connector, timeout=self.timeout,
+                                                  json_serialize=compact_dumps)
+        return self._session
+
+    async def close(self) -> None:
+        """Закрывает HTTP-сессию"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @staticmethod
+    def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+        """Задержка перед повтором: Retry-After от JSONBin или экспонента с полным разбросом"""
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), RETRY_MAX_DELAY)
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    async def _request(self, method: str, url: str, action: str, retries: int = None,
+                       **kwargs) -> Optional[Dict[str, Any]]:
+        """Выполняет запрос с повторами и возвращает JSON ответа или None при ошибке"""
+        if not self.breaker.allow():
+            print(f"{action}: JSONBin недоступен, запрос пропущен")
+            return None
+
+        retries = self.retries if retries is None else retries
+        error = None
+        for attempt in range(retries + 1):
+            retry_after = None
+            try:
+                session = await self._get_session()
+                async with session.request(method, url, **kwargs) as response:
+                    if response.status == 200:
+                        # Оборванное или испорченное тело ответа повторяем, как сетевую ошибку
+                        body = await response.json()
+                        self.breaker.record_success()
+                        return body
+                    error = f"HTTP {response.status}"
+                    if response.status not in RETRYABLE_STATUSES:
+                        # JSONBin ответил осмысленной ошибкой: сервис доступен, повтор не поможет
+                        self.breaker.record_success()
+                        print(f"{action}: {error}")
+                        return None
+                    retry_after = response.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = str(e) or type(e).__name__
+
+            if attempt < retries:
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        self.breaker.record_failure()
+        print(f"{action}: {error}")
+        return None
+
+    async def fetch(self, bin_id: str) -> Optional[Dict[str, Any]]:
+        """Скачивает документ из JSONBin, при ошибке возвращает None"""
+        body = await self._request("GET", f"{JSONBIN_BASE_URL}/{bin_id}/latest", "Ошибка загрузки данных")
+        return body["record"] if body is not None else None
+
+    async def fetch_version(self, bin_id: str) -> Optional[int]:
+        """Узнает версию документа в JSONBin, не скачивая его целиком"""
+        body = await self._request("GET", f"{JSONBIN_BASE_URL}/{bin_id}/latest", "Ошибка проверки версии",
+                                   headers={"X-JSON-Path": "$.version"})
+        if body is None:
+            return None
+        found = body["record"]
+        return int(found[0]) if found else 0
+
+    async def store(self, bin_id: str, data: Dict[str, Any]) -> bool:
+        """Перезаписывает документ в JSONBin"""
+        # PUT заменяет документ целиком, поэтому его безопасно повторять
+        body = await self._request("PUT", f"{JSONBIN_BASE_URL}/{bin_id}", "Ошибка сохранения данных", json=data)
+        return body is not None
+
+    async def create(self, data: Dict[str, Any], name: str = None) -> Optional[str]:
+        """Создает новый приватный бин и возвращает его ID"""
+        headers = {"X-Bin-Private": "true"}
+        if name:
+            headers["X-Bin-Name"] = name
+        # POST не повторяем: после таймаута бин мог быть создан, и повтор создал бы второй
+        body = await self._request("POST", JSONBIN_BASE_URL, "Ошибка создания бина", retries=0,
+                                   json=data, headers=headers)
+        return body["metadata"]["id"] if body is not None else None
+
+
+class JSONBinDocument:
+    """Один бин JSONBin, копия которого хранится в памяти.
+
+    Копия перечитывается, когда другой экземпляр бота сохранил более новую
+    версию документа (см. mark_stale), но только если в ней нет своих
+    неотправленных изменений.
+
+    С log_ratio > 0 сохранение не перезаписывает документ целиком: изменения
+    дописываются записью в бин журнала, и объем запроса зависит от размера
+    изменений с последнего снимка, а не от размера документа. Когда журнал
+    вырастает больше log_ratio от снимка, он сворачивается: документ сохраняется
+    целиком, а журнал начинается заново. При загрузке к снимку применяются
+    записи журнала, которые в него еще не вошли.
+
+    С local_path копия без неотправленных изменений записывается на диск после
+    каждой загрузки и сохранения. При первом обращении документ читается с диска
+    без запроса к JSONBin, а версия в JSONBin сверяется в фоне; до сверки перед
+    сохранением версия проверяется так же, как при optimistic.
+
+    encoding задает формат, в котором документ сохраняется в JSONBin: json —
+    исходный, compact — компактный (см. codec.py), zlib — компактный со сжатием.
+    Читается документ в любом из них, поэтому старый формат заменяется новым
+    при первом сохранении документа целиком.
+    """
+
+    def __init__(self, client: JSONBinClient, bin_id: str, template: Dict[str, Any],
+                 on_stored: Callable[["JSONBinDocument"], Any] = None, optimistic: bool = False,
+                 log_ratio: float = 0, local_path: str = None, on_stale: Callable[[], None] = None,
+                 encoding: str = "json"):
+        self.client = client
+        self.bin_id = bin_id
+        self.template = template
+        # Вызывается после каждого успешного сохранения в JSONBin
+        self.on_stored = on_stored
+        # Перед сохранением сверять версию в JSONBin и переносить свои изменения на более новую
+        self.optimistic = optimistic
+        # Изменения, примененные к копии в памяти после последнего сохранения
+        self.pending: List[Mutation] = []
+        self.data: Optional[Dict[str, Any]] = None
+        # Версия документа в JSONBin, на которой основана копия в памяти
+        self.version = 0
+        # Есть изменения, которые еще не отправлены в JSONBin
+        self.dirty = False
+        # В JSONBin лежит более новая версия, чем в памяти
+        self.stale = False
+        # Вторичные индексы по данным в памяти, перестраиваются при каждой загрузке
+        self.indexes = IndexSet()
+        self._load_lock = asyncio.Lock()
+        self._save_lock = asyncio.Lock()
+
+        # Журнал изменений: записи после снимка и их примерный размер в байтах
+        self.log_ratio = log_ratio
+        self.log_entries: List[Dict[str, Any]] = []
+        self.log_seq = 0
+        self.log_size = 0
+        # Размер снимка в байтах при последней загрузке или сохранении
+        self.snapshot_size = 0
+        # Следующее сохранение должно записать снимок: документ менялся не через apply()
+        self._snapshot_due = False
+        # При загрузке в документ добавлены недостающие разделы шаблона
+        self.repaired = False
+        self.encoding = encoding
+        # Документ в JSONBin лежит не в формате encoding и будет переведен при сохранении
+        self._reformat = False
+
+        # Локальная копия на диске
+        self.local_path = local_path
+        # Вызывается, когда фоновая сверка нашла в JSONBin более новую версию
+        self.on_stale = on_stale
+        # Версия копии сверена с JSONBin: копия скачана оттуда или сверка прошла
+        self.verified = True
+        self.verifier: Optional[asyncio.Task] = None
+        self._local_lock = asyncio.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.data is not None
+
+    async def load(self) -> Dict[str, Any]:
+        """Возвращает документ из памяти, загружая его из JSONBin при первом обращении
+        и после уведомления о более новой версии"""
+        if self.stale and not self.dirty:
+            await self.reload()
+        if self.data is None:
+            async with self._load_lock:
+                # Пока ждали блокировку, документ мог загрузить другой обработчик
+                if self.data is None:
+                    local = await self._read_local()
+                    if local is not None:
+                        self._adopt(*local, verified=False)
+                        self.verifier = asyncio.create_task(self.verify())
+                        return self.data
+                    fetched = await self._fetch()
+                    if fetched is None:
+                        # Неудачную загрузку не кэшируем, чтобы следующий вызов попробовал снова
+                        return copy.deepcopy(self.template)
+                    self._adopt(*fetched)
+                    await self._write_local()
+        return self.data
+
+    def _prepare(self, data: Dict[str, Any]) -> None:
+        """Дополняет скачанный документ недостающими разделами"""
+        for key, value in self.template.items():
+            if key not in data:
+                data[key] = copy.deepcopy(value)
+                self.repaired = True
+        seed_sequences(data)
+
+    async def _fetch(self) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]], int]]:
+        """Скачивает снимок и применяет к нему хвост журнала; возвращает документ, примененные
+        записи журнала и размер снимка или None, если что-то из них недоступно"""
+        stored = await self.client.fetch(self.bin_id)
+        if stored is None:
+            return None
+        snapshot_size = len(compact_dumps(stored))
+        if is_compact(stored) != (self.encoding != "json"):
+            self._reformat = True
+        data = decode_document(stored)
+        self._prepare(data)
+
+        entries = []
+        if data.get("log_bin"):
+            log = await self.client.fetch(data["log_bin"])
+            if log is None:
+                # Снимок без хвоста журнала — не последняя версия документа
+                return None
+            # Записи до log_seq уже в снимке: журнал мог не обнулиться после сворачивания
+            entries = [entry for entry in log.get("entries", []) if entry["seq"] > data.get("log_seq", 0)]
+            for entry in entries:
+                for item in entry["mutations"]:
+                    apply_mutation(data, Mutation(*item))
+                for collection, last_id in entry["sequences"].items():
+                    data["sequences"][collection] = max(data["sequences"].get(collection, 0), last_id)
+                merge_journals(data, entry.get("journals", {}))
+            data["version"] = max(data["version"], log.get("version", 0))
+        return data, entries, snapshot_size
+
+    def _adopt(self, data: Dict[str, Any], entries: List[Dict[str, Any]], snapshot_size: int,
+               verified: bool = True) -> None:
+        """Делает скачанный документ копией в памяти"""
+        self.snapshot_size = snapshot_size
+        self.log_entries = entries
+        self.log_seq = entries[-1]["seq"] if entries else data.get("log_seq", 0)
+        self.log_size = sum(len(compact_dumps(entry)) for entry in entries)
+        self.data = data
+        self.version = data["version"]
+        self.stale = False
+        self.verified = verified
+        self.indexes.rebuild(data)
+
+    async def _read_local(self) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]], int]]:
+        """Читает копию документа с диска в том же виде, что и _fetch()"""
+        if not self.local_path or not os.path.exists(self.local_path):
+            return None
+
+        def read() -> Dict[str, Any]:
+            with open(self.local_path, encoding="utf-8") as file:
+                return json.load(file)
+
+        try:
+            local = await asyncio.to_thread(read)
+            return local["data"], local["log_entries"], local["snapshot_size"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ошибка чтения локальной копии {self.local_path}: {e}")
+            return None
+
+    async def _write_local(self) -> None:
+        """Записывает копию на диск, если в ней нет неотправленных изменений"""
+        if not self.local_path or self.data is None or self.dirty:
+            return
+        # Сериализуем сразу: пока файл пишется в потоке, копия в памяти может измениться
+        text = compact_dumps({"data": self.data, "log_entries": self.log_entries,
+                              "snapshot_size": self.snapshot_size})
+        # Записи идут по очереди, чтобы старая копия не заменила более новую
+        async with self._local_lock:
+            try:
+                await asyncio.to_thread(write_atomic, self.local_path, text)
+            except OSError as e:
+                print(f"Ошибка записи локальной копии {self.local_path}: {e}")
+
+    async def verify(self) -> bool:
+        """Сверяет копию, прочитанную с диска, с версией в JSONBin; False — JSONBin недоступен"""
+        version = await self.fetch_version()
+        if version is None:
+            return False
+        if version <= self.version:
+            self.verified = True
+        elif self.mark_stale(version) and self.on_stale is not None:
+            self.on_stale()
+        return True
+
+    async def fetch_version(self) -> Optional[int]:
+        """Узнает версию документа в JSONBin с учетом журнала, не скачивая его"""
+        version = await self.client.fetch_version(self.bin_id)
+        log_bin = self.data.get("log_bin") if self.data is not None else None
+        if version is None or not log_bin:
+            return version
+        log_version = await self.client.fetch_version(log_bin)
+        return max(version, log_version) if log_version is not None else None
+
+    def mark_dirty(self) -> None:
+        """Отмечает изменения в памяти, откладывая отправку в JSONBin до flush()"""
+        if self.data is None:
+            # Заготовка, которую load() возвращает при ошибке, не должна затереть данные в JSONBin
+            raise RuntimeError(f"Бин {self.bin_id} не загружен из JSONBin, изменения не сохранены")
+        self.dirty = True
+
+    def apply(self, mutation: Mutation) -> bool:
+        """Применяет изменение к загруженной копии в памяти и запоминает его до сохранения"""
+        if self.data is None:
+            raise RuntimeError(f"Бин {self.bin_id} не загружен из JSONBin, изменения не сохранены")
+        changed = apply_mutation(self.data, mutation)
+        if changed is None:
+            return False
+        self.indexes.replace(mutation.collection, mutation.record_id, *changed)
+        self.mark_dirty()
+        self.pending.append(mutation)
+        return True
+
+    def mark_journal(self, journal: str, seq: int) -> bool:
+        """Запоминает, что запись seq журнала journal применена к документу: номер уйдет
+        в JSONBin тем же сохранением, что и ее изменения. False — запись уже была применена"""
+        journals = self.data.setdefault("journals", {})
+        if journals.get(journal, 0) >= seq:
+            return False
+        journals[journal] = seq
+        self.mark_dirty()
+        return True
+
+    def mark_stale(self, version: int) -> bool:
+        """Отмечает, что в JSONBin сохранена версия version; True, если она новее копии в памяти"""
+        if not self.loaded or version <= self.version:
+            return False
+        self.stale = True
+        return True
+
+    async def flush(self) -> bool:
+        """Отправляет документ в JSONBin, если в нем есть неотправленные изменения"""
+        # Сохранения идут по очереди, чтобы старый снимок не перезаписал более новый
+        async with self._save_lock:
+            return await self._flush()
+
+    async def _flush(self) -> bool:
+        if not self.dirty:
+            return True
+        # Копия с диска могла отстать от JSONBin, если процесс остановился до ее записи
+        if (self.optimistic or not self.verified) and not await self._ensure_latest():
+            return False
+        # Флаг снимаем до отправки: изменения, сделанные во время PUT, уйдут следующим flush()
+        self.dirty = False
+        sent = len(self.pending)
+        version = self.version + 1
+        self.data["version"] = version
+        entry = self._log_entry(self.pending[:sent]) if self._can_log() else None
+        if entry is not None:
+            stored = await self._append_log(*entry, version)
+        else:
+            stored = await self._store_snapshot(version)
+        if not stored:
+            self.dirty = True
+            return False
+        self.version = version
+        del self.pending[:sent]
+        await self._write_local()
+        if self.on_stored is not None:
+            await self.on_stored(self)
+        return True
+
+    async def reserve_ids(self, collection: str, count: int, floor: int = 0, stride: int = 1,
+                          remainder: int = 0) -> Optional[List[int]]:
+        """Выдает count новых ID и до возврата сохраняет счетчик в JSONBin, чтобы другой
+        экземпляр не выдал те же ID; None — JSONBin недоступен"""
+        if self.data is None:
+            return None
+        async with self._save_lock:
+            for _ in range(CAS_RETRIES):
+                if not await self._ensure_latest():
+                    return None
+                base = self.version
+                ids = [allocate_id(self.data, collection, floor, stride, remainder) for _ in range(count)]
+                self.mark_dirty()
+                if not await self._flush():
+                    return None
+                # Другой экземпляр успел сохранить документ между сверкой и PUT, и его счетчик
+                # мог выдать те же ID: резервируем заново от его счетчика
+                if self.version == base + 1:
+                    return ids
+            return None
+
+    def _can_log(self) -> bool:
+        # Запись журнала без изменений тоже нужна: она сохраняет счетчики ID
+        return (bool(self.log_ratio) and not self._snapshot_due and not self._reformat
+                and bool(self.data.get("log_bin")))
+
+    def _log_entry(self, mutations: List[Mutation]) -> Optional[Tuple[Dict[str, Any], int]]:
+        """Запись журнала для изменений или None, если пора свернуть журнал в снимок"""
+        entry = {
+            "seq": self.log_seq + 1,
+            "mutations": [list(mutation) for mutation in mutations],
+            # Счетчики ID и номера записей журналов меняются без Mutation, поэтому запись хранит их значения
+            "sequences": dict(self.data.get("sequences", {})),
+        }
+        if self.data.get("journals"):
+            entry["journals"] = dict(self.data["journals"])
+        size = len(compact_dumps(entry))
+        if self.log_size + size > self.snapshot_size * self.log_ratio:
+            return None
+        return entry, size
+
+    async def _append_log(self, entry: Dict[str, Any], size: int, version: int) -> bool:
+        """Дописывает запись в журнал документа"""
+        entries = [*self.log_entries, entry]
+        # JSONBin не умеет дописывать в бин, поэтому журнал отправляется целиком, но он не больше
+        # доли снимка: при переполнении _log_entry() отправляет документ на сворачивание
+        if not await self.client.store(self.data["log_bin"], {"version": version, "entries": entries}):
+            return False
+        self.log_entries = entries
+        self.log_seq = entry["seq"]
+        self.log_size += size
+        return True
+
+    async def _store_snapshot(self, version: int) -> bool:
+        """Сохраняет документ целиком, сворачивая в него журнал"""
+        # Снимок копируется до первого await: изменения, сделанные во время запросов
+        # (и между повторами PUT), остаются в pending и не должны попасть в этот снимок
+        snapshot = copy.deepcopy(self.data)
+        if self.log_ratio and not snapshot.get("log_bin"):
+            # Бин журнала заводится при первом снимке; не получилось — попробуем при следующем
+            log_bin = await self.client.create({"version": version, "entries": []}, f"log-{self.bin_id}")
+            if log_bin is not None:
+                self.data["log_bin"] = snapshot["log_bin"] = log_bin
+        self.data["log_seq"] = snapshot["log_seq"] = self.log_seq
+        if self.encoding == "json":
+            stored = snapshot
+        else:
+            stored = encode_document(snapshot, compress=self.encoding == "zlib")
+        if not await self.client.store(self.bin_id, stored):
+            return False
+        # Старые записи журнала при загрузке отбрасываются по log_seq, поэтому бин журнала
+        # не обнуляем: следующая запись перезапишет его
+        self.log_entries = []
+        self.log_size = 0
+        previous_size, self.snapshot_size = self.snapshot_size, len(compact_dumps(stored))
+        if self._reformat:
+            print(f"Бин {self.bin_id} переведен в формат {self.encoding}: {previous_size} -> {self.snapshot_size} байт")
+        self._snapshot_due = self._reformat = False
+        return True
+
+    async def _ensure_latest(self) -> bool:
+        """Сравнивает версию в JSONBin с версией копии и при расхождении переносит
+        несохраненные изменения на свежий документ; False — не удалось"""
+        for _ in range(CAS_RETRIES):
+            version = await self.fetch_version()
+            if version is None:
+                return False
+            if version <= self.version:
+                self.verified = True
+                return True
+            print(f"Конфликт версий бина {self.bin_id}: {self.version} < {version}, повторяем изменения")
+            if not await self._rebase():
+                return False
+        return False
+
+    async def _rebase(self) -> bool:
+        """Скачивает документ и заново применяет к нему изменения из pending"""
+        fetched = await self._fetch()
+        if fetched is None:
+            return False
+        remote = fetched[0]
+
+        # Разделы, которые убрала или добавила структурная перестройка (переход на шарды), берем свои.
+        # Адрес и положение журнала всегда берем из JSONBin: записи продолжают его журнал
+        for key in [key for key in remote if key not in self.data and key not in LOG_KEYS and key != "journals"]:
+            del remote[key]
+        for key, value in self.data.items():
+            if key not in LOG_KEYS:
+                remote.setdefault(key, copy.deepcopy(value))
+        # Счетчики ID не уменьшаем, а адреса созданных здесь корзин не теряем
+        for collection, last_id in self.data.get("sequences", {}).items():
+            remote["sequences"][collection] = max(remote["sequences"].get(collection, 0), last_id)
+        for bucket, bin_id in self.data.get("shards", {}).items():
+            remote["shards"].setdefault(bucket, bin_id)
+        merge_journals(remote, self.data.get("journals", {}))
+
+        for mutation in self.pending:
+            apply_mutation(remote, mutation)
+
+        self._adopt(*fetched)
+        return True
+
+    async def save(self) -> bool:
+        """Сразу сохраняет измененный в памяти документ в JSONBin целиком"""
+        self.mark_dirty()
+        self._snapshot_due = True
+        return await self.flush()
+
+    async def reload(self) -> bool:
+        """Принудительно перечитывает документ из JSONBin"""
+        if self.dirty:
+            # Не затираем изменения, которые еще не отправлены
+            return False
+        async with self._load_lock:
+            fetched = await self._fetch()
+            if fetched is None:
+                return False
+            if self.dirty:
+                # Пока шла загрузка, в копии появились свои изменения
+                return False
+            self._adopt(*fetched)
+        await self._write_local()
+        return True
+
+
+class JSONBinManager(StorageBackend):
+    """Хранилище на JSONBin.
+
+    При flush_interval > 0 изменения не отправляются сразу: документ помечается
+    измененным, а фоновая задача сохраняет его не чаще раза в flush_interval секунд.
+
+    Без шардирования (shard_count=0) все коллекции лежат в мастер-бине.
+    С шардированием мастер-бин становится каталогом (пользователи и адреса шардов),
+    а сессии, транзакции и долги лежат в shard_count бинах-корзинах: пользователь
+    попадает в корзину user_id % shard_count. Новые ID выдаются так, что
+    ID % shard_count равен номеру корзины, поэтому запись находится без обращения
+    к каталогу. ID, выданные до перехода на шарды, ищутся по корзинам один раз.
+
+    Несколько экземпляров бота могут работать с одними бинами: после сохранения
+    экземпляр публикует новую версию документа в channel, а раз в sync_interval
+    секунд сверяет версии загруженных документов с JSONBin. Более новая версия
+    перечитывается при следующем обращении к документу. С optimistic=True перед
+    каждым сохранением версия сверяется с JSONBin, и при расхождении несохраненные
+    изменения применяются заново поверх свежего документа.
+
+    С log_ratio > 0 каждый документ ведет журнал изменений в отдельном бине и
+    сохраняется целиком, только когда журнал вырастает больше log_ratio от его размера.
+
+    С snapshot_dir документы хранят копии в этой папке, и запуск бота читает их с
+    диска, не дожидаясь JSONBin.
+
+    encoding — формат документов в JSONBin: json, compact или zlib (см. JSONBinDocument).
+    """
+
+    def __init__(self, api_key: str, master_bin_id: str, pool_size: int = 10, shard_count: int = 0,
+                 flush_interval: float = 0, channel: InvalidationChannel = None, sync_interval: float = 0,
+                 optimistic: bool = False, timeout: float = 10, retries: int = 3, log_ratio: float = 0,
+                 snapshot_dir: str = "", encoding: str = "json"):
+        self.client = JSONBinClient(api_key, pool_size, timeout, retries)
+        self.master_bin_id = master_bin_id
+        self.shard_count = shard_count
+        self.flush_interval = flush_interval
+        self.optimistic = optimistic
+        self.log_ratio = log_ratio
+        self.snapshot_dir = snapshot_dir
+        self.encoding = encoding
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+        self._flusher: Optional[asyncio.Task] = None
+        template = DIRECTORY_STRUCTURE if shard_count else INITIAL_DATA_STRUCTURE
+        self.directory = self._document(master_bin_id, template)
+        self._shards: Dict[int, JSONBinDocument] = {}
+        # Найденные корзины для записей со старыми ID: (коллекция, ID) -> корзина
+        self._routes: Dict[Tuple[str, int], int] = {}
+        self._shard_lock = asyncio.Lock()
+
+        # Согласование с другими экземплярами
+        self.instance_id = uuid.uuid4().hex
+        self.channel = channel
+        self.sync_interval = sync_interval
+        self._syncer: Optional[asyncio.Task] = None
+        self._change_listeners: List[Callable[[], None]] = []
+        # Зарезервированные в JSONBin, но еще не выданные ID: (бин, коллекция) -> ID
+        self._id_blocks: Dict[Tuple[str, str], List[int]] = {}
+        if channel is not None:
+            channel.subscribe(self._on_invalidation)
+
+    def _document(self, bin_id: str, template: Dict[str, Any]) -> JSONBinDocument:
+        local_path = os.path.join(self.snapshot_dir, f"{bin_id}.json") if self.snapshot_dir else None
+        return JSONBinDocument(self.client, bin_id, template, on_stored=self._publish, optimistic=self.optimistic,
+                               log_ratio=self.log_ratio, local_path=local_path, on_stale=self._notify_changed,
+                               encoding=self.encoding)
+
+    async def close(self) -> None:
+        for task in (self._flusher, self._syncer, *(document.verifier for document in self._documents())):
+            if task is not None:
+                task.cancel()
+        self._flusher = self._syncer = None
+        await self.flush()
+        await self.client.close()
+
+    async def reload(self) -> bool:
+        """Принудительно перечитывает все загруженные документы из JSONBin"""
+        await self.flush()
+        results = [await self.directory.reload()]
+        for shard in self._shards.values():
+            if shard.loaded:
+                results.append(await shard.reload())
+        return all(results)
+
+    # --- ОТЛОЖЕННАЯ ЗАПИСЬ ---
+
+    def _documents(self) -> List[JSONBinDocument]:
+        return [self.directory, *self._shards.values()]
+
+    def _schedule_flush(self) -> None:
+        """Запускает фоновое сохранение, если оно еще не запущено"""
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        # Все изменения, накопленные за интервал, уходят одним PUT на документ.
+        # Неудачное сохранение повторяется через следующий интервал.
+        while any(document.dirty for document in self._documents()):
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> bool:
+        results = [await document.flush() for document in self._documents()]
+        return all(results)
+
+    # --- СОГЛАСОВАНИЕ ЭКЗЕМПЛЯРОВ ---
+
+    def add_change_listener(self, listener: Callable[[], None]) -> None:
+        self._change_listeners.append(listener)
+
+    def _notify_changed(self) -> None:
+        for listener in self._change_listeners:
+            listener()
+
+    async def _publish(self, document: JSONBinDocument) -> None:
+        """Сообщает другим экземплярам о сохраненной версии документа"""
+        if self.channel is not None:
+            try:
+                await self.channel.publish(self.instance_id, document.bin_id, document.version)
+            except Exception as e:
+                print(f"Ошибка отправки уведомления о версии: {e}")
+
+    async def _on_invalidation(self, source: str, bin_id: str, version: int) -> None:
+        if source == self.instance_id:
+            return
+        for document in self._documents():
+            if document.bin_id == bin_id and document.mark_stale(version):
+                self._notify_changed()
+
+    async def check_versions(self) -> bool:
+        """Сверяет версии загруженных документов с JSONBin; True, если какие-то устарели"""
+        changed = False
+        for document in self._documents():
+            if not document.loaded:
+                continue
+            version = await document.fetch_version()
+            if version is not None and document.mark_stale(version):
+                changed = True
+        if changed:
+            self._notify_changed()
+        return changed
+
+    async def _sync_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            await self.check_versions()
+
+    # --- МАРШРУТИЗАЦИЯ ПО ШАРДАМ ---
+
+    def _is_sharded(self, collection: str) -> bool:
+        return bool(self.shard_count) and collection in SHARDED_COLLECTIONS
+
+    async def _shard(self, bucket: int, create: bool = False) -> Optional[JSONBinDocument]:
+        """Возвращает документ корзины; пустые корзины создаются только при записи"""
+        if bucket in self._shards:
+            return self._shards[bucket]
+
+        directory = await self.directory.load()
+        bin_id = directory["shards"].get(str(bucket))
+
+        if bin_id is None:
+            if not create:
+                return None
+            if not self.directory.loaded:
+                # Пустой каталог из заготовки не значит, что корзины нет
+                raise RuntimeError("Каталог шардов не загружен из JSONBin")
+            async with self._shard_lock:
+                bin_id = directory["shards"].get(str(bucket))
+                if bin_id is None:
+                    shard_data = copy.deepcopy(SHARD_STRUCTURE)
+                    bin_id = await self.client.create(shard_data, f"shard-{bucket}")
+                    if bin_id is None:
+                        raise RuntimeError(f"Не удалось создать бин для корзины {bucket}")
+                    # Пока создавался бин, каталог мог быть перечитан
+                    directory = await self.directory.load()
+                    directory["shards"][str(bucket)] = bin_id
+                    await self.directory.save()
+                    # Только что созданный бин незачем скачивать
+                    self._shards[bucket] = self._document(bin_id, SHARD_STRUCTURE)
+                    self._shards[bucket].data = shard_data
+
+        if bucket not in self._shards:
+            self._shards[bucket] = self._document(bin_id, SHARD_STRUCTURE)
+        return self._shards[bucket]
+
+    async def _locate(self, collection: str, record_id: int) -> Optional[int]:
+        """Возвращает номер корзины, в которой лежит запись"""
+        directory = await self.directory.load()
+        if record_id > directory["legacy_max"].get(collection, 0):
+            return record_id % self.shard_count
+
+        key = (collection, record_id)
+        if key in self._routes:
+            return self._routes[key]
+
+        # Старый ID: сначала смотрим уже загруженные корзины, потом остальные
+        buckets = sorted(range(self.shard_count), key=lambda b: not (b in self._shards and self._shards[b].loaded))
+        for bucket in buckets:
+            shard = await self._shard(bucket)
+            if shard is not None and str(record_id) in (await shard.load())[collection]:
+                self._routes[key] = bucket
+                return bucket
+        return None
+
+    async def _bucket_for(self, collection: str, record: Dict[str, Any]) -> int:
+        """Корзина для новой записи: по владельцу сессии"""
+        if collection == "sessions":
+            return record["user_id"] % self.shard_count
+        session_bucket = await self._locate("sessions", record["session_id"])
+        return session_bucket if session_bucket is not None else record["session_id"] % self.shard_count
+
+    async def _documents_for(self, collection: str, where: Dict[str, Any] = None) -> List[JSONBinDocument]:
+        """Документы, в которых могут лежать записи, подходящие под where"""
+        if not self._is_sharded(collection):
+            return [self.directory]
+
+        where = where or {}
+        if collection == "sessions" and "user_id" in where:
+            buckets = [where["user_id"] % self.shard_count]
+        elif "session_id" in where:
+            bucket = await self._locate("sessions", where["session_id"])
+            buckets = [bucket] if bucket is not None else []
+        else:
+            buckets = range(self.shard_count)
+
+        documents = []
+        for bucket in buckets:
+            shard = await self._shard(bucket)
+            if shard is not None:
+                documents.append(shard)
+        return documents
+
+    async def _migrate_to_shards(self, directory: Dict[str, Any]) -> None:
+        """Однократно переносит сессии, транзакции и долги из мастер-бина по корзинам"""
+        legacy = {collection: directory.pop(collection, {}) for collection in SHARDED_COLLECTIONS}
+        # Счетчики шардированных коллекций теперь ведут корзины
+        for collection in SHARDED_COLLECTIONS:
+            directory.get("sequences", {}).pop(collection, None)
+        directory["legacy_max"] = {
+            collection: max((int(id_) for id_ in records if id_.isdigit()), default=0)
+            for collection, records in legacy.items()
+        }
+
+        session_buckets = {
+            session_id: session.get("user_id", 0) % self.shard_count
+            for session_id, session in legacy["sessions"].items()
+        }
+        buckets: Dict[int, Dict[str, Any]] = {}
+        for collection, records in legacy.items():
+            for record_id, record in records.items():
+                if collection == "sessions":
+                    bucket = session_buckets[record_id]
+                else:
+                    session_id = str(record.get("session_id"))
+                    bucket = session_buckets.get(session_id, int(record.get("session_id") or 0) % self.shard_count)
+                buckets.setdefault(bucket, copy.deepcopy(SHARD_STRUCTURE))[collection][record_id] = record
+
+        for bucket, shard_data in buckets.items():
+            bin_id = await self.client.create(shard_data, f"shard-{bucket}")
+            if bin_id is None:
+                raise RuntimeError(f"Не удалось создать бин для корзины {bucket}")
+            directory["shards"][str(bucket)] = bin_id
+
+        print(f"Данные перенесены в {len(buckets)} шардов")
+
+    # --- ИНТЕРФЕЙС StorageBackend ---
+
+    async def init_schema(self) -> None:
+        data = await self.directory.load()
+        if not self.directory.loaded:
+            # Не перезаписываем мастер-бин пустой структурой, если его не удалось скачать
+            raise RuntimeError("Не удалось загрузить мастер-бин из JSONBin")
+
+        # Сохраняем мастер-бин, только если его структуру пришлось дополнить или перестроить
+        changed = self.directory.repaired
+        if self.shard_count and any(collection in data for collection in SHARDED_COLLECTIONS):
+            await self._migrate_to_shards(data)
+            changed = True
+
+        if changed:
+            await self.directory.save()
+        self.directory.repaired = False
+
+        if self.sync_interval > 0 and (self._syncer is None or self._syncer.done()):
+            self._syncer = asyncio.create_task(self._sync_loop())
+
+    async def get(self, collection: str, record_id: int) -> Optional[Dict[str, Any]]:
+        if self._is_sharded(collection):
+            bucket = await self._locate(collection, record_id)
+            shard = await self._shard(bucket) if bucket is not None else None
+            if shard is None:
+                return None
+            data = await shard.load()
+        else:
+            data = await self.directory.load()
+
+        record = data[collection].get(str(record_id))
+        return dict(record) if record is not None else None
+
+    async def find(self, collection: str, where: Dict[str, Any] = None, since: str = None,
+                   order_by: str = None, descending: bool = False,
+                   limit: int = None) -> List[Tuple[int, Dict[str, Any]]]:
+        rows = []
+
+        for document in await self._documents_for(collection, where):
+            table = (await document.load())[collection]
+            record_ids = document.indexes.lookup(collection, where)
+            if record_ids is None:
+                candidates = ((int(key), record) for key, record in table.items())
+            else:
+                # Индекс сужает выборку до подходящих записей, а не всей коллекции
+                candidates = ((record_id, table[str(record_id)]) for record_id in record_ids
+                              if str(record_id) in table)
+
+            for record_id, record in candidates:
+                if matches(record, where, since):
+                    rows.append((record_id, dict(record)))
+
+        return order_and_limit(rows, order_by, descending, limit)
+
+    async def apply(self, mutations: List[Mutation]) -> bool:
+        return await self._apply(mutations)
+
+    async def apply_journaled(self, journal: str, seq: int, mutations: List[Mutation]) -> bool:
+        return await self._apply(mutations, journal, seq)
+
+    async def _apply(self, mutations: List[Mutation], journal: str = None, seq: int = 0) -> bool:
+        targets: List[Tuple[JSONBinDocument, Mutation]] = []
+
+        # Сначала находим и загружаем все документы, потом меняем их без await между изменениями
+        for mutation in mutations:
+            if self._is_sharded(mutation.collection):
+                if mutation.action == "put":
+                    bucket = await self._bucket_for(mutation.collection, mutation.data)
+                else:
+                    bucket = await self._locate(mutation.collection, mutation.record_id)
+                if bucket is None:
+                    continue
+                document = await self._shard(bucket, create=mutation.action == "put")
+                if document is None:
+                    continue
+            else:
+                document = self.directory
+
+            await document.load()
+            if not document.loaded:
+                # JSONBin недоступен: пачку не применяем, чтобы не сохранить пустую заготовку поверх данных
+                print(f"Ошибка сохранения данных: бин {document.bin_id} не загружен")
+                return False
+            targets.append((document, mutation))
+
+        # Без await копию с несохраненными изменениями не заменит перечитывание
+        # по уведомлению другого экземпляра
+        touched: List[JSONBinDocument] = []
+        if journal is not None:
+            # Документ, который уже сохранил эту запись журнала, ее изменения пропускает
+            fresh = [document for document, _ in targets
+                     if document.data.get("journals", {}).get(journal, 0) < seq]
+            targets = [(document, mutation) for document, mutation in targets
+                       if any(document is doc for doc in fresh)]
+            for document in fresh:
+                if document.mark_journal(journal, seq) and all(document is not doc for doc in touched):
+                    touched.append(document)
+        for document, mutation in targets:
+            if document.apply(mutation) and all(document is not doc for doc in touched):
+                touched.append(document)
+
+        if self.flush_interval > 0:
+            if touched:
+                self._schedule_flush()
+            return True
+
+        results = [await document.flush() for document in touched]
+        return all(results)
+
+    def id_stride(self, collection: str) -> int:
+        return self.shard_count if self._is_sharded(collection) else 1
+
+    async def next_id(self, collection: str, record: Dict[str, Any] = None) -> int:
+        if not self._is_sharded(collection):
+            document, floor, stride, remainder = self.directory, 0, 1, 0
+        else:
+            # ID из корзины b всегда дают остаток b, поэтому корзины не пересекаются
+            bucket = await self._bucket_for(collection, record)
+            directory = await self.directory.load()
+            document = await self._shard(bucket, create=True)
+            floor, stride, remainder = directory["legacy_max"].get(collection, 0), self.shard_count, bucket
+        data = await document.load()
+
+        if not self.optimistic:
+            # Счетчик сохраняется вместе с записью, потому что лежит в том же документе
+            return allocate_id(data, collection, floor, stride, remainder)
+
+        # Несколько экземпляров: при переносе изменений на свежий документ запись с тем же ID
+        # затерла бы чужую, поэтому ID берутся из блока, зарезервированного в JSONBin
+        block = self._id_blocks.setdefault((document.bin_id, collection), [])
+        if not block:
+            reserved = await document.reserve_ids(collection, ID_BLOCK_SIZE, floor, stride, remainder)
+            if reserved is None:
+                raise RuntimeError(f"Не удалось зарезервировать ID коллекции {collection} в JSONBin")
+            block.extend(reserved)
+        return block.pop(0)
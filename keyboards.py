@@ -2,6 +2,7 @@
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardMarkup
 from aiogram.types import InlineKeyboardButton
 from db import get_quick_expense_categories
+from broadcast import short_broadcast_label
 
 
 # --- ГЛАВНОЕ МЕНЮ И НАВИГАЦИЯ ---
@@ -42,15 +43,20 @@ def get_cancel_inline() -> InlineKeyboardMarkup:
 
 # --- АДМИН-ПАНЕЛЬ ---
 
-def get_admin_panel_inline() -> InlineKeyboardMarkup:
-    """Клавиатура админ-панели"""
+def get_admin_panel_inline(broadcast_jobs: list = None) -> InlineKeyboardMarkup:
+    """
+    Клавиатура админ-панели.
+    :param broadcast_jobs: Последние задания рассылки (в очереди, идущие и завершенные)
+    """
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(text="👤 Управление доступом", callback_data="admin_access"))
     builder.add(InlineKeyboardButton(text="👑 Управление админами", callback_data="admin_admins"))
     builder.add(InlineKeyboardButton(text="📢 Массовая рассылка", callback_data="admin_broadcast"))
     builder.add(InlineKeyboardButton(text="📊 Статистика системы", callback_data="admin_stats"))
+    for job in broadcast_jobs or []:
+        builder.add(InlineKeyboardButton(text=short_broadcast_label(job), callback_data=f"admin_bjob_{job['id']}"))
     builder.add(InlineKeyboardButton(text="⬅️ В главное меню", callback_data="nav_start"))
-    builder.adjust(2)
+    builder.adjust(2, 2, *[1] * len(broadcast_jobs or []), 1)
     return builder.as_markup()
 
 
@@ -87,6 +93,15 @@ def get_broadcast_audience_inline() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+def get_broadcast_job_inline(job_id: int) -> InlineKeyboardMarkup:
+    """Клавиатура карточки задания рассылки"""
+    builder = InlineKeyboardBuilder()
+    builder.add(InlineKeyboardButton(text="🔄 Обновить", callback_data=f"admin_bjob_{job_id}"))
+    builder.add(InlineKeyboardButton(text="⬅️ Назад", callback_data="nav_admin_panel"))
+    builder.adjust(2)
+    return builder.as_markup()
+
+
 def get_admin_stats_inline() -> InlineKeyboardMarkup:
     """Клавиатура статистики системы"""
     builder = InlineKeyboardBuilder()
@@ -2,16 +2,20 @@
 import asyncio
 import logging
 import os
+import signal
 import sys
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 
 # Добавляем путь для импортов
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from db import init_db
+from db import init_db, db_manager, flush_user_activity
+from broadcast import resume_broadcasts, stop_broadcasts
 from handlers import register_handlers, AccessMiddleware, FSMTimeoutMiddleware
 
 # --- ЗАГРУЗКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ---
@@ -25,6 +29,15 @@ if not BOT_TOKEN:
 # Получаем порт от Railway (если запускается как веб-сервис)
 PORT = int(os.environ.get("PORT", 8080))
 
+# --- НАСТРОЙКИ ВЕБХУКА ---
+# polling — бот сам опрашивает Telegram, webhook — Telegram присылает обновления на PORT
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Публичный адрес сервиса, например https://bot.up.railway.app
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
 # --- НАСТРОЙКА ЛОГИРОВАНИЯ ---
 logging.basicConfig(
     level=logging.INFO,
@@ -38,9 +51,54 @@ logger = logging.getLogger(__name__)
 
 
 # --- ЗАПУСК ---
+async def run_polling(bot: Bot, dp: Dispatcher) -> None:
+    """Получает обновления длинным опросом Telegram"""
+    # Удаление вебхука и запуск поллинга
+    await bot.delete_webhook(drop_pending_updates=True)
+    logger.info("Бот запущен и ожидает сообщений...")
+    await dp.start_polling(bot)
+
+
+async def health(request: web.Request) -> web.Response:
+    """Проверка живости для балансировщика"""
+    return web.Response(text="OK")
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher) -> None:
+    """Принимает обновления от Telegram на веб-сервере aiohttp"""
+    app = web.Application()
+    app.router.add_get("/", health)
+    # Запросы без верного секрета обработчик отклоняет с 401
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host="0.0.0.0", port=PORT).start()
+
+    # Вебхук не удаляем при остановке: с тем же адресом могут работать другие экземпляры
+    await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types())
+    logger.info(f"Бот запущен в режиме вебхука на порту {PORT}...")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: остановка только по KeyboardInterrupt
+            pass
+
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
 async def main():
     # Инициализация БД
-    init_db()
+    await init_db()
 
     # Инициализация бота и диспетчера
     bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
@@ -55,19 +113,30 @@ async def main():
     dp.message.middleware(FSMTimeoutMiddleware())
     dp.callback_query.middleware(FSMTimeoutMiddleware())
 
-    # Удаление вебхука и запуск поллинга
-    await bot.delete_webhook(drop_pending_updates=True)
-    logger.info("Бот запущен и ожидает сообщений...")
+    # Продолжаем рассылки, прерванные перезапуском
+    resume_broadcasts(bot)
 
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            await run_polling(bot, dp)
     finally:
+        await stop_broadcasts()
+        # Отправляем изменения, накопленные отложенной записью
+        await flush_user_activity()
+        await db_manager.flush()
         await bot.session.close()
+        await db_manager.close()
 
 
 if __name__ == "__main__":
     # Проверяем переменные окружения
-    required_vars = ["BOT_TOKEN", "JSONBIN_API_KEY", "MASTER_BIN_ID"]
+    required_vars = ["BOT_TOKEN"]
+    if os.getenv("STORAGE_BACKEND", "jsonbin").lower() == "jsonbin":
+        required_vars += ["JSONBIN_API_KEY", "MASTER_BIN_ID"]
+    if BOT_MODE == "webhook":
+        required_vars += ["WEBHOOK_URL", "WEBHOOK_SECRET"]
     missing_vars = [var for var in required_vars if not os.getenv(var)]
 
     if missing_vars:
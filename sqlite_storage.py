@@ -0,0 +1,165 @@
+# sqlite_storage.py
+import json
+import sqlite3
+from typing import List, Dict, Any, Optional, Tuple
+
+from storage import Mutation, StorageBackend, apply_increment, order_and_limit
+
+# Поля записи, которые вынесены в отдельные колонки с индексами.
+# Остальные поля хранятся в колонке data вместе с полной копией записи.
+INDEXED_COLUMNS = {
+    "users": ("role",),
+    "sessions": ("user_id", "created_at"),
+    "transactions": ("session_id", "type", "created_at"),
+    "debts": ("session_id", "type", "created_at"),
+    "broadcasts": ("status", "created_at"),
+}
+
+SCHEMA_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_session_type ON transactions (session_id, type, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_session_created ON transactions (session_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_debts_session_type ON debts (session_id, type, created_at)",
+)
+
+
+class SQLiteManager(StorageBackend):
+    """Локальное хранилище в файле SQLite с таблицей и индексами на каждую коллекцию.
+
+    Запросы выполняются синхронно: локальная база с индексами отвечает
+    за доли миллисекунды, а отсутствие await между чтением и записью
+    избавляет от гонок между обработчиками.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открывает соединение и создает схему при первом обращении"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._create_schema(self._conn)
+        return self._conn
+
+    @staticmethod
+    def _create_schema(conn: sqlite3.Connection) -> None:
+        with conn:
+            for table, columns in INDEXED_COLUMNS.items():
+                column_defs = "".join(f", {column}" for column in columns)
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                             f"(id INTEGER PRIMARY KEY{column_defs}, data TEXT NOT NULL)")
+            for statement in SCHEMA_INDEXES:
+                conn.execute(statement)
+            # Номер последней примененной записи каждого локального журнала (journal.py)
+            conn.execute("CREATE TABLE IF NOT EXISTS journals (id TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+
+    @staticmethod
+    def _write_record(conn: sqlite3.Connection, collection: str, record_id: int, record: Dict[str, Any]) -> None:
+        columns = INDEXED_COLUMNS[collection]
+        placeholders = ", ".join("?" for _ in range(len(columns) + 2))
+        conn.execute(
+            f"INSERT OR REPLACE INTO {collection} (id, {', '.join(columns)}, data) VALUES ({placeholders})",
+            (record_id, *(record.get(column) for column in columns), json.dumps(record, ensure_ascii=False))
+        )
+
+    # --- ИНТЕРФЕЙС StorageBackend ---
+
+    async def init_schema(self) -> None:
+        self._connect()
+
+    async def get(self, collection: str, record_id: int) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(f"SELECT data FROM {collection} WHERE id = ?", (record_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def find(self, collection: str, where: Dict[str, Any] = None, since: str = None,
+                   order_by: str = None, descending: bool = False,
+                   limit: int = None) -> List[Tuple[int, Dict[str, Any]]]:
+        columns = INDEXED_COLUMNS[collection]
+        conditions, params, extra = [], [], {}
+
+        for field, value in (where or {}).items():
+            if field in columns:
+                conditions.append(f"{field} = ?")
+                params.append(value)
+            else:
+                extra[field] = value
+
+        if since:
+            conditions.append("created_at >= ?")
+            params.append(since)
+
+        query = f"SELECT id, data FROM {collection}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        # Сортировку и лимит отдаем SQLite, только если все условия попали в индексы
+        sql_ordered = not extra and (order_by is None or order_by in columns)
+        if sql_ordered and order_by:
+            query += f" ORDER BY {order_by} {'DESC' if descending else 'ASC'}"
+        if sql_ordered and limit:
+            query += f" LIMIT {int(limit)}"
+
+        rows = []
+        for record_id, raw in self._connect().execute(query, params):
+            record = json.loads(raw)
+            if extra and any(record.get(field) != value for field, value in extra.items()):
+                continue
+            rows.append((record_id, record))
+
+        if sql_ordered:
+            return rows
+        return order_and_limit(rows, order_by, descending, limit)
+
+    @classmethod
+    def _write_mutations(cls, conn: sqlite3.Connection, mutations: List[Mutation]) -> None:
+        for mutation in mutations:
+            if mutation.action == "put":
+                cls._write_record(conn, mutation.collection, mutation.record_id, mutation.data)
+            elif mutation.action in ("update", "increment"):
+                row = conn.execute(f"SELECT data FROM {mutation.collection} WHERE id = ?",
+                                   (mutation.record_id,)).fetchone()
+                if row:
+                    record = json.loads(row[0])
+                    if mutation.action == "update":
+                        record.update(mutation.data)
+                    else:
+                        record = apply_increment(record, mutation.data)
+                    cls._write_record(conn, mutation.collection, mutation.record_id, record)
+            elif mutation.action == "delete":
+                conn.execute(f"DELETE FROM {mutation.collection} WHERE id = ?", (mutation.record_id,))
+
+    async def apply(self, mutations: List[Mutation]) -> bool:
+        conn = self._connect()
+        try:
+            with conn:
+                self._write_mutations(conn, mutations)
+            return True
+        except sqlite3.Error as e:
+            print(f"Ошибка сохранения данных: {e}")
+            return False
+
+    async def apply_journaled(self, journal: str, seq: int, mutations: List[Mutation]) -> bool:
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT seq FROM journals WHERE id = ?", (journal,)).fetchone()
+                if row and row[0] >= seq:
+                    return True
+                self._write_mutations(conn, mutations)
+                conn.execute("INSERT OR REPLACE INTO journals (id, seq) VALUES (?, ?)", (journal, seq))
+            return True
+        except sqlite3.Error as e:
+            print(f"Ошибка сохранения данных: {e}")
+            return False
+
+    async def next_id(self, collection: str, record: Dict[str, Any] = None) -> int:
+        row = self._connect().execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {collection}").fetchone()
+        return row[0]
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,291 @@
+# storage.py
+from typing import List, Dict, Any, Optional, Tuple, NamedTuple, Set, Callable
+
+# Коллекции, из которых состоит база данных бота
+COLLECTIONS = ("users", "sessions", "transactions", "debts", "broadcasts")
+
+# Поля вторичных индексов в памяти для хранилищ без собственных индексов.
+# Поиск по индексу требует первого поля, остальные уточняют выборку.
+INDEXED_FIELDS = {
+    "sessions": ("user_id",),
+    "transactions": ("session_id", "type"),
+    "debts": ("session_id", "type", "is_repaid"),
+}
+
+
+class Mutation(NamedTuple):
+    """Одно изменение записи: put — вставка/замена, update — частичное обновление,
+    increment — прибавка к счетчикам во вложенном поле, delete — удаление"""
+    action: str
+    collection: str
+    record_id: int
+    data: Optional[Dict[str, Any]] = None
+
+
+def put(collection: str, record_id: int, record: Dict[str, Any]) -> Mutation:
+    return Mutation("put", collection, record_id, record)
+
+
+def update(collection: str, record_id: int, fields: Dict[str, Any]) -> Mutation:
+    return Mutation("update", collection, record_id, fields)
+
+
+def increment(collection: str, record_id: int, field: str, deltas: Dict[str, float]) -> Mutation:
+    return Mutation("increment", collection, record_id, {field: deltas})
+
+
+def delete(collection: str, record_id: int) -> Mutation:
+    return Mutation("delete", collection, record_id)
+
+
+def _add_counters(counters: Dict[str, Any], deltas: Dict[str, Any]) -> Dict[str, Any]:
+    counters = dict(counters)
+    for key, delta in deltas.items():
+        if isinstance(delta, dict):
+            counters[key] = _add_counters(counters.get(key) or {}, delta)
+        else:
+            counters[key] = counters.get(key, 0) + delta
+    return counters
+
+
+def apply_increment(record: Dict[str, Any], data: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Возвращает копию записи со счетчиками, увеличенными на data (счетчики могут быть вложенными).
+    Отсутствующее поле записи не создается: такие счетчики пересчитываются целиком."""
+    record = dict(record)
+    for field, deltas in data.items():
+        if isinstance(record.get(field), dict):
+            record[field] = _add_counters(record[field], deltas)
+    return record
+
+
+def matches(record: Dict[str, Any], where: Dict[str, Any] = None, since: str = None) -> bool:
+    """Проверяет запись на условия find()"""
+    if where and any(record.get(field) != value for field, value in where.items()):
+        return False
+    if since and (record.get("created_at") or "") < since:
+        return False
+    return True
+
+
+def order_and_limit(rows: List[Tuple[int, Dict[str, Any]]], order_by: str = None, descending: bool = False,
+                    limit: int = None) -> List[Tuple[int, Dict[str, Any]]]:
+    """Сортирует и обрезает результат выборки одинаково для всех хранилищ"""
+    if order_by:
+        rows.sort(key=lambda row: row[1].get(order_by) or "", reverse=descending)
+    if limit:
+        rows = rows[:limit]
+    return rows
+
+
+class RecordIndex:
+    """Индекс в памяти: дерево значений полей fields, в листьях — множества ID записей"""
+
+    def __init__(self, fields: Tuple[str, ...]):
+        self.fields = fields
+        self._tree: Dict[Any, Any] = {}
+
+    def clear(self) -> None:
+        self._tree = {}
+
+    def add(self, record_id: int, record: Dict[str, Any]) -> None:
+        node = self._tree
+        for field in self.fields[:-1]:
+            node = node.setdefault(record.get(field), {})
+        node.setdefault(record.get(self.fields[-1]), set()).add(record_id)
+
+    def remove(self, record_id: int, record: Dict[str, Any]) -> None:
+        path = [self._tree]
+        for field in self.fields:
+            node = path[-1].get(record.get(field))
+            if node is None:
+                return
+            path.append(node)
+
+        path[-1].discard(record_id)
+        # Убираем опустевшие ветки, чтобы индекс не рос от удаленных сессий
+        for depth in range(len(self.fields), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][record.get(self.fields[depth - 1])]
+
+    def lookup(self, where: Dict[str, Any]) -> Set[int]:
+        """ID записей, у которых индексированные поля совпадают с where"""
+        nodes = [self._tree]
+        for field in self.fields:
+            if field in where:
+                nodes = [node[where[field]] for node in nodes if where[field] in node]
+            else:
+                nodes = [child for node in nodes for child in node.values()]
+        return set().union(*nodes)
+
+
+class IndexSet:
+    """Вторичные индексы всех коллекций одного документа"""
+
+    def __init__(self):
+        self.indexes = {collection: RecordIndex(fields) for collection, fields in INDEXED_FIELDS.items()}
+
+    def rebuild(self, data: Dict[str, Any]) -> None:
+        """Строит индексы заново по содержимому документа"""
+        for collection, index in self.indexes.items():
+            index.clear()
+            for record_id, record in data.get(collection, {}).items():
+                if record_id.isdigit():
+                    index.add(int(record_id), record)
+
+    def replace(self, collection: str, record_id: int, old: Optional[Dict[str, Any]],
+                new: Optional[Dict[str, Any]]) -> None:
+        """Отражает в индексе замену записи old на new (None — записи нет)"""
+        index = self.indexes.get(collection)
+        if index is None:
+            return
+        if old is not None:
+            index.remove(record_id, old)
+        if new is not None:
+            index.add(record_id, new)
+
+    def lookup(self, collection: str, where: Dict[str, Any] = None) -> Optional[Set[int]]:
+        """ID кандидатов по индексу или None, если индекс к where не подходит"""
+        index = self.indexes.get(collection)
+        if index is None or not where or index.fields[0] not in where:
+            return None
+        return index.lookup(where)
+
+
+class StorageBackend:
+    """Интерфейс хранилища, через который работают функции db.py.
+
+    Записи адресуются парой (коллекция, числовой ID). Все изменения передаются
+    в apply() пачкой и сохраняются атомарно, одной операцией записи.
+    """
+
+    async def init_schema(self) -> None:
+        """Создает недостающие коллекции/таблицы"""
+        raise NotImplementedError
+
+    async def get(self, collection: str, record_id: int) -> Optional[Dict[str, Any]]:
+        """Возвращает копию записи или None"""
+        raise NotImplementedError
+
+    async def find(self, collection: str, where: Dict[str, Any] = None, since: str = None,
+                   order_by: str = None, descending: bool = False,
+                   limit: int = None) -> List[Tuple[int, Dict[str, Any]]]:
+        """Возвращает пары (ID, копия записи), у которых поля совпадают с where,
+        а created_at не раньше since"""
+        raise NotImplementedError
+
+    async def apply(self, mutations: List[Mutation]) -> bool:
+        """Применяет пачку изменений и сохраняет их одной операцией"""
+        raise NotImplementedError
+
+    async def apply_journaled(self, journal: str, seq: int, mutations: List[Mutation]) -> bool:
+        """Применяет запись seq локального журнала journal (journal.py), если хранилище ее еще
+        не сохранило. Номер записи сохраняется той же операцией, что и изменения, поэтому
+        повторная отправка записи после сбоя не прибавляет increment второй раз"""
+        return await self.apply(mutations)
+
+    async def next_id(self, collection: str, record: Dict[str, Any] = None) -> int:
+        """Возвращает следующий свободный ID для новой записи record в коллекции"""
+        raise NotImplementedError
+
+    async def flush(self) -> bool:
+        """Сохраняет отложенные изменения, если хранилище их копит"""
+        return True
+
+    async def close(self) -> None:
+        """Освобождает соединения"""
+
+    async def put(self, collection: str, record_id: int, record: Dict[str, Any]) -> bool:
+        return await self.apply([put(collection, record_id, record)])
+
+    async def update(self, collection: str, record_id: int, fields: Dict[str, Any]) -> bool:
+        return await self.apply([update(collection, record_id, fields)])
+
+    async def delete(self, collection: str, record_id: int) -> bool:
+        return await self.apply([delete(collection, record_id)])
+
+    def id_stride(self, collection: str) -> int:
+        """Шаг между соседними ID, которые хранилище выдает для коллекции"""
+        return 1
+
+    def add_change_listener(self, listener: Callable[[], None]) -> None:
+        """Подписывает listener на изменения данных, сделанные другими экземплярами бота.
+        Хранилища, с которыми работает один процесс, его не вызывают."""
+
+
+class UnitOfWork(StorageBackend):
+    """Единица работы поверх хранилища.
+
+    Чтения идут в хранилище с учетом еще не сохраненных изменений этой единицы,
+    а все изменения копятся и отправляются одним apply() в commit().
+    """
+
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+        self.mutations: List[Mutation] = []
+        # Результат commit(): удалось ли сохранить изменения
+        self.committed = False
+        # Текущее состояние измененных записей: (коллекция, ID) -> запись или None, если удалена
+        self._pending: Dict[Tuple[str, int], Optional[Dict[str, Any]]] = {}
+
+    async def get(self, collection: str, record_id: int) -> Optional[Dict[str, Any]]:
+        key = (collection, record_id)
+        if key in self._pending:
+            record = self._pending[key]
+            return dict(record) if record is not None else None
+        return await self.backend.get(collection, record_id)
+
+    async def find(self, collection: str, where: Dict[str, Any] = None, since: str = None,
+                   order_by: str = None, descending: bool = False,
+                   limit: int = None) -> List[Tuple[int, Dict[str, Any]]]:
+        touched = {record_id for name, record_id in self._pending if name == collection}
+        if not touched:
+            return await self.backend.find(collection, where, since, order_by, descending, limit)
+
+        rows = [row for row in await self.backend.find(collection, where, since) if row[0] not in touched]
+        for (name, record_id), record in self._pending.items():
+            if name == collection and record is not None and matches(record, where, since):
+                rows.append((record_id, dict(record)))
+        return order_and_limit(rows, order_by, descending, limit)
+
+    async def apply(self, mutations: List[Mutation]) -> bool:
+        for mutation in mutations:
+            # Изменение отсутствующей записи хранилище само пропустит
+            self.mutations.append(mutation)
+            key = (mutation.collection, mutation.record_id)
+            if mutation.action == "put":
+                self._pending[key] = dict(mutation.data)
+            elif mutation.action == "update":
+                record = await self.get(*key)
+                if record is not None:
+                    record.update(mutation.data)
+                    self._pending[key] = record
+            elif mutation.action == "increment":
+                record = await self.get(*key)
+                if record is not None:
+                    self._pending[key] = apply_increment(record, mutation.data)
+            elif mutation.action == "delete":
+                self._pending[key] = None
+        return True
+
+    async def next_id(self, collection: str, record: Dict[str, Any] = None) -> int:
+        record_id = await self.backend.next_id(collection, record)
+        # ID, выданные в этой единице, хранилище еще не видит. Следующий берем у хранилища,
+        # чтобы его счетчик тоже прошел занятые ID; хранилище без счетчика (MAX(id) + 1)
+        # вернет тот же ID, и тогда шагаем сами
+        while (collection, record_id) in self._pending:
+            candidate = await self.backend.next_id(collection, record)
+            record_id = candidate if candidate > record_id else record_id + self.backend.id_stride(collection)
+        return record_id
+
+    def release(self, waiting: Set[Tuple[str, int]]) -> None:
+        """Забывает изменения, которые уже сохранены в хранилище, кроме записей waiting,
+        чьи изменения еще не сохранены"""
+        self.mutations.clear()
+        for key in [key for key in self._pending if key not in waiting]:
+            del self._pending[key]
+
+    async def commit(self) -> bool:
+        """Сохраняет все накопленные изменения одной операцией"""
+        self.committed = not self.mutations or await self.backend.apply(self.mutations)
+        return self.committed
@@ -0,0 +1,92 @@
+# tests/test_journal.py
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import storage
+from journal import JournaledStorage
+from jsonbin_storage import JSONBinManager
+from test_jsonbin_storage import FakeJSONBinClient
+
+
+class JournalRestartTest(unittest.IsolatedAsyncioTestCase):
+    """Журнал записи поверх JSONBin переживает перезапуск, пока JSONBin недоступен"""
+
+    async def asyncSetUp(self):
+        self.client = FakeJSONBinClient()
+        self.client.bins["master"] = {"users": {}, "sessions": {"1": {"user_id": 1, "stats": {"total_sales": 0}}}}
+        self.path = os.path.join(tempfile.mkdtemp(), "journal.log")
+
+    async def _open(self) -> JournaledStorage:
+        with mock.patch("jsonbin_storage.JSONBinClient", return_value=self.client):
+            journaled = JournaledStorage(JSONBinManager("key", "master", flush_interval=1), self.path)
+        await journaled.init_schema()
+        return journaled
+
+    async def _sale(self, journaled: JournaledStorage, amount: float) -> int:
+        transaction_id = await journaled.next_id("transactions")
+        await journaled.apply([
+            storage.put("transactions", transaction_id, {"session_id": 1, "amount": amount}),
+            storage.increment("sessions", 1, "stats", {"total_sales": amount}),
+        ])
+        return transaction_id
+
+    async def test_ids_are_not_reused_after_restart(self):
+        journaled = await self._open()
+        self.client.down = True
+        ids = [await self._sale(journaled, 1.0), await self._sale(journaled, 2.0)]
+        # Аварийная остановка: журнал не отправлен
+        journaled._replayer.cancel()
+        self.client.down = False
+
+        restarted = await self._open()
+        ids += [await self._sale(restarted, 3.0), await self._sale(restarted, 4.0)]
+        self.assertTrue(await restarted.flush())
+        ids.append(await self._sale(restarted, 5.0))
+        self.assertTrue(await restarted.flush())
+        await restarted.close()
+
+        stored = self.client.bins["master"]
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual({record["amount"] for record in stored["transactions"].values()}, {1.0, 2.0, 3.0, 4.0, 5.0})
+        self.assertEqual(stored["sessions"]["1"]["stats"]["total_sales"], 15.0)
+
+
+    async def test_sent_entries_are_not_applied_again_after_restart(self):
+        journaled = await self._open()
+        # Аварийная остановка после сохранения в JSONBin, но до записи ack
+        journaled._acknowledge = mock.AsyncMock()
+        await self._sale(journaled, 10.0)
+        self.assertTrue(await journaled.flush())
+        journaled._replayer.cancel()
+
+        restarted = await self._open()
+        self.assertTrue(await restarted.flush())
+        await restarted.close()
+
+        stored = self.client.bins["master"]
+        self.assertEqual(len(stored["transactions"]), 1)
+        self.assertEqual(stored["sessions"]["1"]["stats"]["total_sales"], 10.0)
+
+    async def test_concurrent_sales_are_all_sent(self):
+        journaled = await self._open()
+        ids = await asyncio.gather(*(self._sale(journaled, float(amount)) for amount in range(1, 21)),
+                                   journaled.replay(), journaled.replay())
+        self.assertTrue(await journaled.flush())
+        await journaled.close()
+
+        stored = self.client.bins["master"]
+        self.assertEqual(len(stored["transactions"]), 20)
+        self.assertEqual(stored["sessions"]["1"]["stats"]["total_sales"], 210.0)
+        # Все отправлено: в журнале осталась только строка с его ID
+        with open(self.path, encoding="utf-8") as journal:
+            self.assertEqual(len(journal.readlines()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
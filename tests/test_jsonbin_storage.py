@@ -0,0 +1,141 @@
+# tests/test_jsonbin_storage.py
+import asyncio
+import copy
+import os
+import sys
+import unittest
+from typing import Dict, Any, Optional
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+from jsonbin_storage import JSONBinManager
+
+
+class FakeJSONBinClient:
+    """JSONBin в памяти с тем же интерфейсом, что у JSONBinClient"""
+
+    def __init__(self, *args, **kwargs):
+        self.bins: Dict[str, Dict[str, Any]] = {}
+        # JSONBin недоступен: запросы завершаются ошибкой
+        self.down = False
+
+    async def fetch(self, bin_id: str) -> Optional[Dict[str, Any]]:
+        if self.down:
+            return None
+        return copy.deepcopy(self.bins[bin_id]) if bin_id in self.bins else None
+
+    async def fetch_version(self, bin_id: str) -> Optional[int]:
+        if self.down:
+            return None
+        return self.bins[bin_id].get("version", 0) if bin_id in self.bins else None
+
+    async def store(self, bin_id: str, data: Dict[str, Any]) -> bool:
+        if self.down:
+            return False
+        self.bins[bin_id] = copy.deepcopy(data)
+        return True
+
+    async def create(self, data: Dict[str, Any], name: str = None) -> Optional[str]:
+        bin_id = f"bin{len(self.bins)}"
+        self.bins[bin_id] = copy.deepcopy(data)
+        return bin_id
+
+    async def close(self) -> None:
+        pass
+
+
+class ConcurrentInstancesTest(unittest.IsolatedAsyncioTestCase):
+    """Несколько экземпляров бота с optimistic=True пишут в один бин"""
+
+    async def _start(self, shard_count: int = 0):
+        self.client = FakeJSONBinClient()
+        self.client.bins["master"] = {"users": {}, "sessions": {"1": {"user_id": 1, "stats": {"total_sales": 0}}}}
+        with mock.patch("jsonbin_storage.JSONBinClient", return_value=self.client):
+            instances = [JSONBinManager("key", "master", shard_count=shard_count, optimistic=True)
+                         for _ in range(2)]
+        for instance in instances:
+            await instance.init_schema()
+        return instances
+
+    async def test_new_records_get_distinct_ids(self):
+        instances = await self._start()
+        ids = []
+        for step in range(6):
+            instance = instances[step % 2]
+            transaction_id = await instance.next_id("transactions")
+            ids.append(transaction_id)
+            await instance.apply([
+                storage.put("transactions", transaction_id, {"session_id": 1, "amount": 1.0}),
+                storage.increment("sessions", 1, "stats", {"total_sales": 1.0}),
+            ])
+
+        stored = self.client.bins["master"]
+        self.assertEqual(len(set(ids)), 6)
+        self.assertEqual(sorted(stored["transactions"]), sorted(str(record_id) for record_id in ids))
+        self.assertEqual(stored["sessions"]["1"]["stats"]["total_sales"], 6.0)
+
+    async def test_new_records_get_distinct_ids_in_shards(self):
+        instances = await self._start(shard_count=2)
+        ids = []
+        for step in range(6):
+            instance = instances[step % 2]
+            session_id = await instance.next_id("sessions", {"user_id": 1})
+            ids.append(session_id)
+            await instance.put("sessions", session_id, {"user_id": 1, "stats": {}})
+
+        with mock.patch("jsonbin_storage.JSONBinClient", return_value=self.client):
+            reader = JSONBinManager("key", "master", shard_count=2)
+        self.assertEqual(len(set(ids)), 6)
+        self.assertEqual(len(await reader.find("sessions", {"user_id": 1})), 7)
+
+
+class SlowStoreClient(FakeJSONBinClient):
+    """JSONBin, у которого PUT документа ждет сигнала, прежде чем прочитать тело запроса"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # До armed PUT идет без задержки: тест сначала готовит бин
+        self.armed = False
+        self.storing = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def store(self, bin_id: str, data: Dict[str, Any]) -> bool:
+        if bin_id == "master" and self.armed and not self.release.is_set():
+            self.storing.set()
+            await self.release.wait()
+        return await super().store(bin_id, data)
+
+
+class SnapshotTest(unittest.IsolatedAsyncioTestCase):
+    """Снимок документа не захватывает изменения, сделанные во время его отправки"""
+
+    async def test_changes_during_store_are_applied_once(self):
+        client = SlowStoreClient()
+        client.bins["master"] = {"users": {}, "sessions": {"1": {"user_id": 1, "stats": {"total_sales": 0}}}}
+        with mock.patch("jsonbin_storage.JSONBinClient", return_value=client):
+            # Первая загрузка дополняет документ и сохраняет его, чтобы следующая загрузка его не меняла
+            await JSONBinManager("key", "master").init_schema()
+            manager = JSONBinManager("key", "master", flush_interval=60, log_ratio=1.0)
+            reader = JSONBinManager("key", "master")
+        await manager.init_schema()
+        client.armed = True
+
+        await manager.apply([storage.increment("sessions", 1, "stats", {"total_sales": 1.0})])
+        flush = asyncio.create_task(manager.flush())
+        await client.storing.wait()
+        await manager.apply([storage.increment("sessions", 1, "stats", {"total_sales": 2.0})])
+        client.release.set()
+        self.assertTrue(await flush)
+        # Бин журнала заведен первым снимком: второе изменение уходит записью журнала
+        self.assertTrue(await manager.flush())
+
+        await reader.init_schema()
+        session = await reader.get("sessions", 1)
+        self.assertEqual(session["stats"]["total_sales"], 3.0)
+        await manager.close()
+
+
+if __name__ == "__main__":
+    unittest.main()